@@ -1,11 +1,15 @@
 #!/usr/bin/python3
 
-from glob import glob
+from collections import Counter
+from concurrent.futures import ProcessPoolExecutor
 from pprint import pformat
 import argparse
+import image_probe
 import logging
+import ocr_engine
 import os
-import shutil
+import pdf_assemble
+import PIL.Image
 import subprocess
 import sys
 import tempfile
@@ -15,19 +19,8 @@ PAPER_SIZE = (8.5, 11)
 
 RESOLUTION = {"hi": 300, "lo": 150}
 
-
-def find_imagemagick_binary():
-    # Check for the new `magick` binary used in ImageMagick 7+
-    magick_path = shutil.which("magick")
-    if magick_path:
-        return "magick"
-
-    # Check for the older `convert` binary used in ImageMagick < 7
-    convert_path = shutil.which("convert")
-    if convert_path:
-        return "convert"
-
-    return None
+# ImageMagick's default quality when the input isn't a JPEG
+JPEG_QUALITY = 92
 
 
 def validate_dirpath(dirpath: str) -> str:
@@ -43,6 +36,16 @@ def validate_filepath(filepath):
     return os.path.realpath(filepath)
 
 
+def positive_int(value):
+    try:
+        i = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value!r} is not a valid integer")
+    if i <= 0:
+        raise argparse.ArgumentTypeError("value must be a positive integer")
+    return i
+
+
 def scandir(dirpath):
     """Return directory entries sorted by name."""
     return sorted(os.scandir(dirpath), key=lambda e: e.name)
@@ -59,6 +62,112 @@ def do_cmd(cmdlist, **kwargs):
     return process
 
 
+def fit_to_page(img, size):
+    """Resize `img` to fit within `size` and center it on a white page.
+
+    Equivalent to ImageMagick's ``-resize WxH -gravity center -extent WxH``.
+    """
+    scale = min(size[0] / img.width, size[1] / img.height)
+    new_size = (
+        max(1, round(img.width * scale)),
+        max(1, round(img.height * scale)),
+    )
+    resized = img.resize(new_size, PIL.Image.LANCZOS)
+    page = PIL.Image.new(img.mode, size, "white")
+    page.paste(
+        resized, ((size[0] - new_size[0]) // 2, (size[1] - new_size[1]) // 2)
+    )
+    return page
+
+
+def ocr_page(src_img, tmpdir, page_num, dimensions, tess_config):
+    """OCR a page image and create a pdf page for each resolution profile.
+
+    If the source is a grayscale or RGB JPEG that already has a
+    profile's page size, its compressed data is embedded as is in that
+    profile's page. Otherwise the source image is decoded once and
+    every profile is resized from the in-memory copy. Tesseract, whose
+    model is loaded once per worker process, only runs on the highest
+    resolution image, producing a text-only pdf. Since every profile
+    has the same paper size, the text layer's coordinates (in pdf
+    points) line up with each profile's page and it is placed over
+    every profile's image when the pages are assembled.
+
+    Returns a tuple of a dict mapping profile name to single page image
+    pdf path, and "text" to the text-only pdf, and the list of profiles
+    whose page reuses the source JPEG.
+    """
+    info = image_probe.probe(src_img)
+    logging.debug("%s", info)
+    passthrough = []
+    if info["format"] == "JPEG" and info["mode"] in ("L", "RGB"):
+        passthrough = [
+            name
+            for name in RESOLUTION
+            if (info["width"], info["height"]) == dimensions[name]
+        ]
+
+    ocr_name = max(RESOLUTION, key=RESOLUTION.get)
+    page_base = os.path.join(tmpdir, f"{page_num:03d}")
+
+    # tesseract takes the page size of its pdf from the image's dpi
+    ocr_img = f"{page_base}_{ocr_name}.jpg"
+    if ocr_name in passthrough and image_probe.set_jpeg_density(
+        src_img, RESOLUTION[ocr_name]
+    ):
+        ocr_img = src_img
+
+    pdf_files = {}
+    for name in passthrough:
+        logging.debug("%s %s: using source jpeg", src_img, name)
+        pdf_files[name] = f"{page_base}_{name}_img.pdf"
+        pdf_assemble.jpeg_page(src_img, pdf_files[name], RESOLUTION[name])
+
+    # profiles that need a resized copy of the source image
+    resize = [name for name in RESOLUTION if name not in passthrough]
+    if ocr_img != src_img and ocr_name not in resize:
+        resize.append(ocr_name)
+
+    pages = {}
+    if resize:
+        with PIL.Image.open(src_img) as img:
+            # keep the quality of jpeg sources, like convert did
+            quality = image_probe.jpeg_quality(img) or JPEG_QUALITY
+            if img.mode not in ("L", "RGB"):
+                img = img.convert("RGB")
+            else:
+                img.load()
+    for name in resize:
+        pages[name] = fit_to_page(img, dimensions[name])
+        logging.debug(
+            "%s %s: %s %dx%d %d dpi",
+            src_img,
+            name,
+            pages[name].mode,
+            *pages[name].size,
+            RESOLUTION[name],
+        )
+
+    if ocr_img != src_img:
+        pages[ocr_name].save(
+            ocr_img, quality=quality, dpi=(RESOLUTION[ocr_name],) * 2
+        )
+    text_base = f"{page_base}_text"
+    ocr_engine.recognize(
+        ocr_img, text_base, formats=["pdf"], config=tess_config, textonly=True
+    )
+
+    # the text layer is drawn over the images when the pages are
+    # assembled
+    pdf_files["text"] = text_base + ".pdf"
+    for name, dpi in RESOLUTION.items():
+        if name in passthrough:
+            continue
+        pdf_files[name] = f"{page_base}_{name}_img.pdf"
+        pages[name].save(pdf_files[name], resolution=dpi, quality=quality)
+    return pdf_files, passthrough
+
+
 def main():
     parser = argparse.ArgumentParser(description="OCR pdf file")
     parser.add_argument(
@@ -68,69 +177,71 @@ def main():
     parser.add_argument(
         "-d", "--debug", help="Enable debugging messages", action="store_true"
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=positive_int,
+        default=1,
+        metavar="N",
+        help="Number of pages to process in parallel (default: %(default)s)",
+    )
     args = parser.parse_args()
 
     level = logging.DEBUG if args.debug else logging.WARNING
     logging.basicConfig(format="%(levelname)s: %(message)s", level=level)
 
-    tess_args = ["-c", "tessedit_do_invert=0"]
+    tess_config = {"tessedit_do_invert": 0}
     if not args.debug:
-        tess_args.append("quiet")
+        tess_config["debug_file"] = os.devnull
 
-    convert = find_imagemagick_binary()
-    if not convert:
-        sys.exit("No ImageMagick binary found.")
+    # Each worker runs its own tesseract engine, so keep it
+    # single threaded to avoid oversubscribing the cpus.
+    if args.jobs > 1:
+        os.environ["OMP_THREAD_LIMIT"] = "1"
 
     dimensions = {}
     for name, dpi in RESOLUTION.items():
-        dimensions[name] = "x".join(
-            tuple(str(int(dim_in_inches * dpi)) for dim_in_inches in PAPER_SIZE)
+        dimensions[name] = tuple(
+            int(dim_in_inches * dpi) for dim_in_inches in PAPER_SIZE
         )
 
     with tempfile.TemporaryDirectory() as tmpdir:
         output_base = os.path.join(tmpdir, "out")
         do_cmd(["pdfimages", "-j", args.input_file, output_base])
         page_entries = scandir(tmpdir)
-        for name, dpi in RESOLUTION.items():
-            for i, entry in enumerate(page_entries, start=1):
-                do_cmd(["identify", entry.path])
-                resized_img = os.path.join(tmpdir, f"{i:03d}_{name}.jpg")
-                do_cmd([
-                    convert,
-                    entry.path,
-                    "-resize",
-                    dimensions[name],
-                    "-background",
-                    "white",
-                    "-gravity",
-                    "center",
-                    "-extent",
-                    dimensions[name],
-                    "-units",
-                    "PixelsPerInch",
-                    "-density",
-                    str(dpi),
-                    resized_img,
-                ])
-                do_cmd(["identify", resized_img])
-
-                pdf_base = os.path.join(tmpdir, f"{i:03d}_{name}")
-                do_cmd([
-                    "tesseract",
-                    resized_img,
-                    pdf_base,
-                    *tess_args,
-                    "pdf",
-                ])
-
-            pdf_files = sorted(glob(os.path.join(tmpdir, f"*_{name}.pdf")))
-            tmp_file = os.path.join(tmpdir, f"tmp_{name}.pdf")
-            do_cmd(["pdftk", *pdf_files, "cat", "output", tmp_file])
 
+        pdf_files = {name: [] for name in ("text", *RESOLUTION)}
+        num_passthrough = Counter()
+
+        with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+            futures = [
+                executor.submit(
+                    ocr_page, entry.path, tmpdir, i, dimensions, tess_config
+                )
+                for i, entry in enumerate(page_entries, start=1)
+            ]
+            try:
+                for future in futures:
+                    page_files, passthrough = future.result()
+                    for name, pdf_file in page_files.items():
+                        pdf_files[name].append(pdf_file)
+                    num_passthrough.update(passthrough)
+            except BaseException:
+                # fail fast instead of waiting for the remaining pages
+                executor.shutdown(cancel_futures=True)
+                raise
+
+        for name in RESOLUTION:
             out_file = f"{args.output_base}_{name}.pdf"
-            shutil.move(tmp_file, out_file)
+            pdf_assemble.assemble(
+                pdf_files[name], out_file, overlays=pdf_files["text"]
+            )
 
             do_cmd(["pdfimages", "-list", out_file])
+            print(
+                f"{out_file}: {num_passthrough[name]} of "
+                f"{len(pdf_files[name])} pages used the source jpeg as is"
+            )
 
 
 if __name__ == "__main__":
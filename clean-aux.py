@@ -1,12 +1,23 @@
 #!/usr/bin/python3
 
 import argparse
+import fnmatch
+import json
 import logging
 import os
+import threading
 import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pprint import pformat
 from typing import Optional
 
+import yaml
+
+# regeneration cost of files that match no retention rule
+DEFAULT_COST = 10
+
+ONE_DAY_IN_SECS = 24 * 60 * 60
+
 
 def validate_dirpath(dirpath: str) -> str:
     """Validates a dirpath and returns it if valid."""
@@ -26,15 +37,116 @@ def positive_float(value):
     except ValueError:
         raise argparse.ArgumentTypeError(f"{value!r} is not a valid number")
     if f <= 0:
-        raise argparse.ArgumentTypeError(
-            "age must be a positive number of days"
-        )
+        raise argparse.ArgumentTypeError(f"{value!r} must be positive")
     return f
 
 
+class RateLimiter:
+    """Space out calls from any number of threads by `1 / rate` secs."""
+
+    def __init__(self, rate: float):
+        self.min_delay = 1 / rate
+        self.lock = threading.Lock()
+        self.next_time = 0.0
+
+    def wait(self) -> None:
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.min_delay
+        if start > now:
+            time.sleep(start - now)
+
+
+def format_size(num_bytes: int) -> str:
+    return f"{num_bytes / 1024**2:.1f} MiB"
+
+
+def load_policy(policy_file: str) -> list:
+    """
+    Load retention rules from a YAML policy file.
+
+    See conf/retention.yaml for the format. Returns a list of rule dicts
+    with pattern, action, max_age (in seconds or None) and cost.
+    """
+    with open(policy_file) as f:
+        policy = yaml.safe_load(f) or {}
+
+    rules = []
+    for i, rule in enumerate(policy.get("rules") or [], 1):
+        if not isinstance(rule, dict) or "pattern" not in rule:
+            raise ValueError(f"{policy_file}: rule {i} has no pattern")
+        action = rule.get("action", "delete")
+        if action not in ("keep", "delete"):
+            raise ValueError(
+                f"{policy_file}: rule {i} action must be keep or delete"
+            )
+        max_age = rule.get("max_age")
+        rules.append({
+            "pattern": rule["pattern"],
+            "action": action,
+            "max_age": max_age * ONE_DAY_IN_SECS if max_age else None,
+            "cost": float(rule.get("cost", DEFAULT_COST)),
+        })
+    return rules
+
+
+def match_rule(rules: Optional[list], name: str) -> Optional[dict]:
+    """Return the first rule whose pattern matches `name`."""
+    for rule in rules or []:
+        if fnmatch.fnmatchcase(name, rule["pattern"]):
+            return rule
+    return None
+
+
+def remove_file(
+    path: str,
+    size: int,
+    summary: dict,
+    *,
+    dry_run: bool,
+    rate_limiter: Optional[RateLimiter] = None,
+) -> bool:
+    """Delete `path` and add it to `summary`. Returns True on success."""
+    if dry_run:
+        logging.debug("Would delete %s", path)
+    else:
+        if rate_limiter:
+            rate_limiter.wait()
+        logging.debug("Deleting %s", path)
+        try:
+            os.remove(path)
+        except FileNotFoundError:
+            return False
+        except OSError as e:
+            logging.warning("Can't delete %s: %s", path, e)
+            summary["errors"] += 1
+            return False
+
+    summary["files"] += 1
+    summary["bytes"] += size
+    return True
+
+
+def is_real_dir(aux_dir: str) -> bool:
+    if not os.path.isdir(aux_dir) or os.path.islink(aux_dir):
+        logging.warning(
+            "Skipping %s: not a real directory (symlinks are ignored)",
+            aux_dir,
+        )
+        return False
+    return True
+
+
 def purge(
-    aux_dir: str, *, cutoff_time: float, exclude: Optional[str], dry_run: bool
-) -> None:
+    aux_dir: str,
+    *,
+    cutoff_time: float,
+    exclude: Optional[str],
+    dry_run: bool,
+    rate_limiter: Optional[RateLimiter] = None,
+    rules: Optional[list] = None,
+) -> dict:
     """
     Purge files from a directory using modification time and optional
     exclusions.
@@ -44,6 +156,10 @@ def purge(
     unless excluded. Symlinks and non-directory paths are skipped. Deletion
     can be simulated with `dry_run`.
 
+    Files matching a retention rule are handled by the rule instead:
+    keep rules never delete a file, delete rules delete it once it is
+    older than the rule's max_age, or right away if it has none.
+
     Args:
         aux_dir (str): Path to the directory to purge.
         cutoff_time (float): Epoch timestamp; files with mtime >= cutoff_time
@@ -51,33 +167,55 @@ def purge(
         exclude (Optional[str]): If provided, files whose names end with this
             string are skipped.
         dry_run (bool): If True, only log files that would be deleted.
+        rate_limiter (Optional[RateLimiter]): If provided, used to throttle
+            deletions.
+        rules (Optional[list]): Retention rules from `load_policy`.
 
     Returns:
-        None
+        dict: Number of files and bytes deleted (or that would be
+        deleted) and number of files that couldn't be deleted.
 
     Logs:
         - Warnings if `aux_dir` is not a real directory (symlinks ignored)
         - Debug messages for excluded files, dry-run actions, and deletions.
     """
-    if not os.path.isdir(aux_dir) or os.path.islink(aux_dir):
-        logging.warning(
-            "Skipping %s: not a real directory (symlinks are ignored)",
-            aux_dir,
-        )
-        return
+    summary = {"files": 0, "bytes": 0, "errors": 0}
+
+    if not is_real_dir(aux_dir):
+        return summary
+
+    now = time.time()
 
     for entry in scan_dir(aux_dir):
         if entry.is_dir():
             logging.warning("Skipping directory %s", entry.path)
             continue
 
-        if exclude and entry.name.endswith(exclude):
+        rule = match_rule(rules, entry.name)
+        if rule and rule["action"] == "keep":
+            logging.debug("Keeping %s (%s)", entry.path, rule["pattern"])
+            continue
+
+        if not rule and exclude and entry.name.endswith(exclude):
             logging.debug("Excluding %s", entry.path)
             continue
 
-        mtime = entry.stat().st_mtime
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            # removed since the directory was scanned
+            continue
+        mtime = st.st_mtime
 
-        if mtime < cutoff_time:
+        if rule:
+            if rule["max_age"] and now - mtime < rule["max_age"]:
+                logging.debug(
+                    "Keeping %s, younger than max_age of %s",
+                    entry.path,
+                    rule["pattern"],
+                )
+                continue
+        elif mtime < cutoff_time:
             last_modified = time.strftime(
                 "%Y-%m-%d %H:%M:%S", time.localtime(mtime)
             )
@@ -86,11 +224,157 @@ def purge(
             )
             continue
 
-        if dry_run:
-            logging.debug("Would delete %s", entry.path)
-        else:
-            logging.debug("Deleting %s", entry.path)
-            os.remove(entry.path)
+        remove_file(
+            entry.path,
+            st.st_size,
+            summary,
+            dry_run=dry_run,
+            rate_limiter=rate_limiter,
+        )
+
+    return summary
+
+
+def purge_books(
+    se_dir: str, id_list: list, *, jobs: int = 1, **kwargs
+) -> dict:
+    """
+    Purge the aux directory of each book in `id_list` using a pool of
+    `jobs` threads.
+
+    Returns a dict mapping each book id to its `purge` summary. If the
+    run is interrupted, the summaries of the books finished so far are
+    returned; purging is idempotent so rerunning picks up the rest.
+    """
+    results = {}
+    executor = ThreadPoolExecutor(max_workers=jobs)
+    futures = {}
+    try:
+        for obj_id in id_list:
+            aux_dir = os.path.join(se_dir, obj_id, "aux")
+            logging.debug("aux_dir=%s", aux_dir)
+            futures[executor.submit(purge, aux_dir, **kwargs)] = obj_id
+        for future in as_completed(futures):
+            obj_id = futures[future]
+            results[obj_id] = summary = future.result()
+            if summary["files"]:
+                logging.info(
+                    "%s: %s in %d files",
+                    obj_id,
+                    format_size(summary["bytes"]),
+                    summary["files"],
+                )
+    except KeyboardInterrupt:
+        logging.warning(
+            "Interrupted, %d books not purged", len(id_list) - len(results)
+        )
+    finally:
+        executor.shutdown(wait=True, cancel_futures=True)
+    return results
+
+
+def scan_aux(aux_dir: str) -> list:
+    """Return (name, path, size, mtime) of each file in `aux_dir`."""
+    files = []
+    if not is_real_dir(aux_dir):
+        return files
+    for entry in scan_dir(aux_dir):
+        if entry.is_dir():
+            continue
+        try:
+            st = entry.stat()
+        except FileNotFoundError:
+            continue
+        files.append((entry.name, entry.path, st.st_size, st.st_mtime))
+    return files
+
+
+def evict_to_budget(
+    se_dir: str,
+    id_list: list,
+    *,
+    budget: int,
+    exclude: Optional[str],
+    dry_run: bool,
+    rate_limiter: Optional[RateLimiter] = None,
+    rules: Optional[list] = None,
+    jobs: int = 1,
+) -> tuple:
+    """
+    Delete files from the aux directories of the books in `id_list`
+    until they use at most `budget` bytes in total.
+
+    Files are deleted cheapest to regenerate first, going by the cost
+    of the retention rule they match, and oldest first among files of
+    the same cost. Files matching a keep rule or `exclude` are never
+    deleted.
+
+    Returns a dict mapping each book id to its summary, like
+    `purge_books`, and the number of bytes left in the aux directories.
+    """
+    aux_dirs = [os.path.join(se_dir, obj_id, "aux") for obj_id in id_list]
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        listings = list(executor.map(scan_aux, aux_dirs))
+
+    usage = 0
+    candidates = []
+    for obj_id, files in zip(id_list, listings):
+        for name, path, size, mtime in files:
+            usage += size
+            rule = match_rule(rules, name)
+            if rule:
+                if rule["action"] == "keep":
+                    continue
+                cost = rule["cost"]
+            elif exclude and name.endswith(exclude):
+                continue
+            else:
+                cost = DEFAULT_COST
+            candidates.append((cost, mtime, obj_id, path, size))
+    logging.debug(
+        "aux usage %s, budget %s", format_size(usage), format_size(budget)
+    )
+
+    results = {
+        obj_id: {"files": 0, "bytes": 0, "errors": 0} for obj_id in id_list
+    }
+    for cost, mtime, obj_id, path, size in sorted(candidates):
+        if usage <= budget:
+            break
+        if remove_file(
+            path,
+            size,
+            results[obj_id],
+            dry_run=dry_run,
+            rate_limiter=rate_limiter,
+        ):
+            usage -= size
+
+    if usage > budget:
+        logging.warning(
+            "Only deletable files down to %s, over budget of %s",
+            format_size(usage),
+            format_size(budget),
+        )
+    for obj_id, summary in results.items():
+        if summary["files"]:
+            logging.info(
+                "%s: %s in %d files",
+                obj_id,
+                format_size(summary["bytes"]),
+                summary["files"],
+            )
+    return results, usage
+
+
+def write_report(report_file: str, report: dict) -> None:
+    """Write the JSON run report, "-" for stdout."""
+    text = json.dumps(report, indent=2)
+    if report_file == "-":
+        print(text)
+    else:
+        with open(report_file, "w") as f:
+            f.write(text + "\n")
 
 
 def main():
@@ -119,6 +403,44 @@ def main():
     parser.add_argument(
         "-e", "--exclude", help="exclude files matching extension"
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="Number of books to purge concurrently (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--max-delete-rate",
+        type=positive_float,
+        metavar="FILES",
+        help="Delete at most FILES files per second across all jobs",
+    )
+    parser.add_argument(
+        "-p",
+        "--policy",
+        metavar="FILE",
+        help=(
+            "YAML retention policy, e.g. conf/retention.yaml; files "
+            "matching no rule follow --age and --exclude"
+        ),
+    )
+    parser.add_argument(
+        "-b",
+        "--budget",
+        type=positive_float,
+        metavar="GB",
+        help=(
+            "Instead of purging by age, delete the cheapest to "
+            "regenerate, oldest files until the aux directories use at "
+            "most GB gigabytes"
+        ),
+    )
+    parser.add_argument(
+        "--report",
+        metavar="FILE",
+        help="Write a JSON report of reclaimed space to FILE ('-' for stdout)",
+    )
 
     group = parser.add_mutually_exclusive_group()
     group.add_argument(
@@ -145,6 +467,9 @@ def main():
 
     args = parser.parse_args()
 
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
     script_name = os.path.basename(os.path.realpath(__file__))
     level = logging.WARNING if args.quiet else logging.DEBUG
     logging.basicConfig(
@@ -161,21 +486,81 @@ def main():
         id_list = [entry.name for entry in scan_dir(se_dir) if entry.is_dir()]
     logging.debug("ids=%s", pformat(id_list))
 
+    rules = None
+    if args.policy:
+        try:
+            rules = load_policy(args.policy)
+        except (OSError, ValueError, yaml.YAMLError) as e:
+            parser.error(f"Can't load policy: {e}")
+        logging.debug("rules=%s", pformat(rules))
+
     now = time.time()
     # Define the age threshold (in seconds)
-    one_day_in_secs = 24 * 60 * 60
-    cutoff_time = now - args.age * one_day_in_secs
+    cutoff_time = now - args.age * ONE_DAY_IN_SECS
 
-    for obj_id in id_list:
-        aux_dir = os.path.join(se_dir, obj_id, "aux")
-        logging.debug("aux_dir=%s", aux_dir)
-        purge(
-            aux_dir,
+    rate_limiter = None
+    if args.max_delete_rate:
+        rate_limiter = RateLimiter(args.max_delete_rate)
+
+    budget = int(args.budget * 1024**3) if args.budget else None
+    usage = None
+    if budget:
+        results, usage = evict_to_budget(
+            se_dir,
+            id_list,
+            budget=budget,
+            exclude=args.exclude,
+            dry_run=args.dry_run,
+            rate_limiter=rate_limiter,
+            rules=rules,
+            jobs=args.jobs,
+        )
+    else:
+        results = purge_books(
+            se_dir,
+            id_list,
+            jobs=args.jobs,
             cutoff_time=cutoff_time,
             exclude=args.exclude,
             dry_run=args.dry_run,
+            rate_limiter=rate_limiter,
+            rules=rules,
+        )
+
+    total = {"books": len(results), "files": 0, "bytes": 0, "errors": 0}
+    for summary in results.values():
+        for key in ("files", "bytes", "errors"):
+            total[key] += summary[key]
+    logging.info(
+        "%s %s in %d files from %d books",
+        "Would reclaim" if args.dry_run else "Reclaimed",
+        format_size(total["bytes"]),
+        total["files"],
+        total["books"],
+    )
+
+    if args.report:
+        write_report(
+            args.report,
+            {
+                "rstar_dir": args.rstar_dir,
+                "started": now,
+                "finished": time.time(),
+                "dry_run": args.dry_run,
+                "cutoff_time": None if args.budget else cutoff_time,
+                "budget_bytes": budget,
+                "aux_bytes": usage,
+                "complete": len(results) == len(id_list),
+                "total": total,
+                "books": {
+                    obj_id: results[obj_id] for obj_id in sorted(results)
+                },
+            },
         )
 
+    if total["errors"] or len(results) < len(id_list):
+        exit(1)
+
 
 if __name__ == "__main__":
     main()
@@ -67,11 +67,7 @@ $log->debug("wip dir: $wip_dir");
 
 my @ids = @ARGV ? @ARGV : Util::get_dir_contents($wip_dir);
 
-my ($version) = sys("tesseract -v") =~ /^tesseract (\d+\.\d+)/;
-$log->debug("Tesseract version: $version");
-
-my @output_ext = "txt";
-push(@output_ext, $version >= 3.03 ? "hocr" : "html");
+my @output_ext = qw(txt hocr);
 
 for my $id (@ids)
 {
@@ -98,30 +94,54 @@ for my $id (@ids)
 
 	my @tifs = sort(glob("$data_dir/$id*d.tif"));
 
+	# Pages still missing an ocr file
+	my @pages;
 	for my $tif_file (@tifs)
 	{
 		my $basename = basename($tif_file);
 		$basename =~ s/_?d\.tif$//;
-		my $output_base = "$tmpdir/${basename}_ocr";
 
+		my @missing;
 		for my $ext (@output_ext)
 		{
-			my $tmp_file    = "$output_base.$ext";
 			my $output_file = "$aux_dir/${basename}_ocr.$ext";
-
 			if (!$opt_f && -f $output_file)
 			{
 				$log->warn("ocr file $output_file already exists.");
 				next;
 			}
-
-			my $cmd = "tesseract $tif_file $output_base -l $lang";
-			$cmd .= " hocr" if $ext =~ /^(html|hocr)$/;
-			my $output = sys($cmd);
+			push(@missing, $ext);
+		}
+		push(@pages, [$tif_file, "$tmpdir/${basename}_ocr", \@missing])
+		  if @missing;
+	}
+	next if !@pages;
+
+	# Recognize every page once, writing all formats, with the
+	# language model loaded only once for the whole book
+	my $list_file = "$tmpdir/${id}_ocr.list";
+	open(my $out, ">$list_file")
+	  or $log->logdie("can't open $list_file: $!");
+	print $out map { "$_->[0]\t$_->[1]\n" } @pages;
+	close($out);
+	sys("$FindBin::Bin/ocr_engine.py -l $lang -f "
+		. join(",", @output_ext)
+		. " --list $list_file");
+
+	for my $page (@pages)
+	{
+		my ($tif_file, $output_base, $missing) = @$page;
+		my $basename = basename($output_base);
+		for my $ext (@$missing)
+		{
+			my $tmp_file    = "$output_base.$ext";
+			my $output_file = "$aux_dir/$basename.$ext";
 			$log->info("Moving $tmp_file to $host:$output_file");
 			move($tmp_file, $output_file)
 			  or $log->logdie("can't move $tmp_file to $output_file: $!");
 		}
+		# remove outputs that already existed
+		unlink(map { "$output_base.$_" } @output_ext);
 	}
 }
 
@@ -16,6 +16,7 @@ use File::Copy;
 use File::Temp qw(tempdir);
 use File::Which;
 use Getopt::Long;
+use JSON;
 use LangCode;
 use Log::Log4perl::Level;
 use MODS;
@@ -324,12 +325,9 @@ for my $id (@ids)
 		{
 			my $limit =
 			  @file_ids < $max_page_check ? @file_ids : $max_page_check;
-			my $num_white = 0;
-			for (my $i = 0 ; $i < $limit ; $i++)
-			{
-				my $input_file = "$aux_dir/$file_ids[$i]_s.jpg";
-				$num_white++ if is_page_white($input_file);
-			}
+			my @sample_files =
+			  map { "$aux_dir/$file_ids[$_]_s.jpg" } 0 .. $limit - 1;
+			my $num_white = count_white_pages(@sample_files);
 			$log->debug("Found $num_white out of $limit white pages.");
 			$bg_color = $num_white > $limit / 2 ? 'white' : 'black';
 			$log->debug("Setting background color to $bg_color.");
@@ -360,17 +358,9 @@ sub merge_pdfs
 {
 	my ($input_files, $output_file) = @_;
 	my $tmp_file = "$tmpdir/" . basename($output_file);
-	if (which("pdftk")) {
-		sys("pdftk "
-			. join(" ", @{$input_files})
-			. " cat output $tmp_file");
-	} else {
-		my @libs = qw(pdfbox pdfbox-tools commons-logging);
-		sys("java -Xms512m -Xmx512m -cp "
-			. join(':', map("/usr/share/java/${_}.jar", @libs))
-			. " org.apache.pdfbox.tools.PDFMerger "
-			. join(" ", @{$input_files}, $tmp_file));
-	}
+	# Concatenate, strip metadata and linearize in a single write
+	sys("$FindBin::Bin/pdf_assemble.py -o $tmp_file "
+		. join(" ", @{$input_files}));
 	$log->info("Moving $tmp_file to $host:$output_file");
 	move($tmp_file, $output_file)
 	  or $log->logdie("can't move $tmp_file to $output_file: $!");
@@ -382,21 +372,22 @@ sub merge_pdfs
 }
 
 
-# Detect if page is white by drawing one pixel border around
-# image and calling ImageMagick's auto-crop operator.  Returns
-# true if bounding box of cropped image is smaller than geometry
-# of original image.
-sub is_page_white
+# Count pages whose border is mostly white.  All pages are checked
+# by a single image_probe.py process, which reads a downsampled copy
+# of each image, instead of running ImageMagick twice per page.
+sub count_white_pages
 {
-	my $input_file = shift;
-	my $orig_dim = sys("$convert_bin $input_file -format '%g' info:");
-	my $crop_dim = sys("$convert_bin $input_file -bordercolor white "
-		  . "-border 1x1 -format '%\@' info:");
-	$log->debug("Original dimensions: $orig_dim");
-	$log->debug("Crop dimensions: $crop_dim");
-	$orig_dim =~ s/\+.*//;
-	$crop_dim =~ s/\+.*//;
-	$orig_dim ne $crop_dim;
+	my @input_files = @_;
+	my $output = sys("$FindBin::Bin/image_probe.py --white @input_files");
+	my $num_white = 0;
+	for my $line (split(/\n/, $output))
+	{
+		my $info = decode_json($line);
+		$log->debug("White border $info->{file}: "
+			  . ($info->{white} ? "yes" : "no"));
+		$num_white++ if $info->{white};
+	}
+	return $num_white;
 }
 
 
@@ -47,6 +47,7 @@ Requires:       php-cli
 Requires:       python3-countryinfo
 Requires:       python3-geopy
 Requires:       python3-lxml
+Requires:       python3-pikepdf
 Requires:       python3-pillow
 Requires:       python3-pyyaml
 Requires:       python3-redis
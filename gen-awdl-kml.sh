@@ -20,6 +20,6 @@ do
 	[ ! -s "$kml_file" ] && rm -f $kml_file
 done
 
-$bindir/merge-kml.py $tmpdir/*.kml | xmllint --format - > awdl.kml
+$bindir/merge-kml.py --dedupe $tmpdir/*.kml | xmllint --format - > awdl.kml
 
 
@@ -48,7 +48,7 @@ my $scale = {
 
 my $log = MyLogger->get_logger();
 
-our $opt_f;  # force removal of coordinates file
+our $opt_f;  # force regeneration of coordinates files
 our $opt_g;  # use google for geocoder
 our $opt_q;  # quiet logging
 our $opt_r;  # rstar directory
@@ -126,6 +126,19 @@ for my $color (@colors, "ylw")
 
 my $num_placemarks = 0;
 
+my %area_of;
+
+# Look up coordinates for all books in one run so each distinct
+# location is only sent to the geocoder once
+for my $wip_dir (@wip_dirs)
+{
+	my $geo_cmd = "$app_home/geo-coords.py --wip-dir $wip_dir";
+	$geo_cmd .= " -g google" if $opt_g;
+	$geo_cmd .= " --force" if $opt_f;
+	$geo_cmd .= " @wip_ids" if @wip_ids;
+	sys($geo_cmd, {warnErrors => 1});
+}
+
 for my $wip_dir (@wip_dirs)
 {
 	my @ids = @wip_ids ? @wip_ids : Util::get_dir_contents($wip_dir);
@@ -171,13 +184,6 @@ for my $wip_dir (@wip_dirs)
 		my $coord;
 		my $out;
 
-		if ($opt_f && -f $coord_file)
-		{
-			$log->debug("Removing $coord_file.");
-			unlink($coord_file)
-				or $log->logdie("Can't unlink $coord_file: $!");
-		}
-
 # 		if (-f $coord_file)
 # 		{
 # 			$coord = read_coords_from_file($coord_file);
@@ -201,15 +207,6 @@ for my $wip_dir (@wip_dirs)
 # 			  or $log->logdie("can't move $tmp_file to $coord_file: $!");
 # 		}
 
-		if (! -f $coord_file)
-		{
-			my $geo_cmd = "$app_home/geo-coords.py";
-# 			$geo_cmd .= " --debug" unless $opt_q;
-			$geo_cmd .= " -g google" if $opt_g;
-			$geo_cmd .= " $mods_file $coord_file";
-			my $output = sys($geo_cmd, {warnErrors => 1});
-		}
-
 		if (! -f $coord_file)
 		{
 			$log->debug("Couldn't find coordinates. Skipping ...");
@@ -218,7 +215,9 @@ for my $wip_dir (@wip_dirs)
 
 		$coord = read_coords_from_file($coord_file);
 
-		my $area = sys("$app_home/lookup-area.py",
+		# many books share a location so only look up each area once
+		my $area = $area_of{$coord->{location}} //=
+		  sys("$app_home/lookup-area.py",
 			$coord->{location}, {warnErrors => 1}) || 0;
 
 		$log->debug("Area $coord->{location}: $area");
@@ -18,45 +18,404 @@
 #
 # Author: Rasan
 
+from concurrent.futures import ThreadPoolExecutor, as_completed
+from geopy.exc import GeopyError
 from geopy.geocoders import get_geocoder_for_service
 from lxml import etree
 import argparse
-import importlib
+import functools
+import glob
 import json
 import logging
 import os
+import sqlite3
 import sys
+import threading
+import time
 import yaml
 
 
-def lookup_coord(loc_name, geocoder):
+# Cache of geocoder results shared by all runs
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "book-publisher",
+)
+CACHE_FILE = os.path.join(CACHE_DIR, "geocode.sqlite")
+
+ONE_DAY_IN_SECS = 24 * 60 * 60
+
+# Minimum seconds between requests to each geocoder service, see
+# https://operations.osmfoundation.org/policies/nominatim/
+MIN_DELAY = {"nominatim": 1.0, "google": 0.02}
+DEFAULT_MIN_DELAY = 1.0
+
+
+def normalize_name(loc_name):
+    """Normalize case and whitespace of a location name."""
+    return " ".join(loc_name.split()).casefold()
+
+
+class GeocodeCache:
+    """
+    SQLite cache of geocoder lookups keyed by location name and geocoder.
+
+    Locations the geocoder couldn't find are cached too, so they aren't
+    looked up on every run, but they expire after `negative_ttl`
+    seconds instead of `ttl` seconds.
+    """
+
+    def __init__(self, path, ttl, negative_ttl):
+        os.makedirs(os.path.dirname(os.path.abspath(path)), exist_ok=True)
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS geocode (
+                name TEXT,
+                geocoder TEXT,
+                latitude REAL,
+                longitude REAL,
+                updated REAL,
+                PRIMARY KEY (name, geocoder)
+            )
+            """)
+        self.ttl = ttl
+        self.negative_ttl = negative_ttl
+
+    def get(self, loc_name, geocoder):
+        """
+        Return a tuple of whether `loc_name` was found in the cache and
+        its coordinates, None if the geocoder couldn't find it.
+        """
+        row = self.conn.execute(
+            "SELECT latitude, longitude, updated FROM geocode"
+            " WHERE name = ? AND geocoder = ?",
+            (normalize_name(loc_name), geocoder),
+        ).fetchone()
+        if not row:
+            return False, None
+        lat, lng, updated = row
+        ttl = self.negative_ttl if lat is None else self.ttl
+        if time.time() - updated > ttl:
+            return False, None
+        return True, None if lat is None else [lat, lng]
+
+    def put(self, loc_name, geocoder, coord):
+        lat, lng = coord or (None, None)
+        with self.conn:
+            self.conn.execute(
+                "INSERT OR REPLACE INTO geocode VALUES (?, ?, ?, ?, ?)",
+                (normalize_name(loc_name), geocoder, lat, lng, time.time()),
+            )
+
+    def close(self):
+        self.conn.close()
+
+
+@functools.lru_cache(maxsize=None)
+def get_geolocator(geocoder):
     geocoder_class = get_geocoder_for_service(geocoder)
     logging.debug("geocoder class: %s", geocoder_class)
-    ua_name = "dlts_geo_app/0.1"
-    geolocator = geocoder_class(**geocoder_args)
-    location = geolocator.geocode(loc_name)
-    if not location:
+
+    # User agent str for calls to web service
+    geocoder_args = {"user_agent": "dlts_geo_app/0.1"}
+    if geocoder in ["google"]:
+        geocoder_args["api_key"] = os.environ["MAPS_API_KEY"]
+    return geocoder_class(**geocoder_args)
+
+
+class RateLimiter:
+    """Space out calls from any number of threads by `min_delay` secs."""
+
+    def __init__(self, min_delay):
+        self.min_delay = min_delay
+        self.lock = threading.Lock()
+        self.next_time = 0
+
+    def wait(self):
+        with self.lock:
+            now = time.monotonic()
+            start = max(now, self.next_time)
+            self.next_time = start + self.min_delay
+        if start > now:
+            time.sleep(start - now)
+
+
+def geocode(loc_name, geocoder, rate_limiter=None):
+    """Query the geocoder service for [latitude, longitude] of loc_name."""
+    if rate_limiter:
+        rate_limiter.wait()
+    logging.debug("Querying %s for %s", geocoder, loc_name)
+    location = get_geolocator(geocoder).geocode(loc_name)
+    return [location.latitude, location.longitude] if location else None
+
+
+def lookup_coord(loc_name, geocoder, cache=None, offline=False):
+    """Return [latitude, longitude] of `loc_name` or None if not found."""
+    if cache:
+        found, coord = cache.get(loc_name, geocoder)
+        if found:
+            logging.debug("Cached coordinates for %s: %s", loc_name, coord)
+            return coord
+
+    if offline:
+        logging.debug("%s isn't cached, skipping geocoder", loc_name)
+        return None
+
+    coord = geocode(loc_name, geocoder)
+    if cache:
+        cache.put(loc_name, geocoder, coord)
+    return coord
+
+
+def lookup_many(
+    queries, geocoder, cache=None, offline=False, jobs=1, min_delay=None
+):
+    """
+    Return a dict mapping each of `queries` to its coordinates.
+
+    Names that aren't cached are sent to the geocoder from a pool of
+    `jobs` threads, with requests spaced at least `min_delay` seconds
+    apart to honor the service's usage policy. Names the geocoder
+    couldn't be queried for are left out of the dict.
+    """
+    coords = {}
+    misses = []
+    for query in queries:
+        found, coord = cache.get(query, geocoder) if cache else (False, None)
+        if found:
+            coords[query] = coord
+        else:
+            misses.append(query)
+    logging.debug("%d of %d locations cached", len(coords), len(queries))
+
+    if offline or not misses:
+        return coords
+
+    if min_delay is None:
+        min_delay = MIN_DELAY.get(geocoder, DEFAULT_MIN_DELAY)
+    rate_limiter = RateLimiter(min_delay)
+    get_geolocator(geocoder)
+
+    # sqlite connections can't be shared between threads so the cache
+    # is only updated here
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        futures = {
+            executor.submit(geocode, query, geocoder, rate_limiter): query
+            for query in misses
+        }
+        for future in as_completed(futures):
+            query = futures[future]
+            try:
+                coord = future.result()
+            except GeopyError as e:
+                logging.warning("Geocoder error for %s: %s", query, e)
+                continue
+            coords[query] = coord
+            if cache:
+                cache.put(query, geocoder, coord)
+    return coords
+
+
+def get_location(mods_file):
+    """Return the first lcsh geographic subject in a MODS file."""
+    nsmap = {"m": "http://www.loc.gov/mods/v3"}
+    xpath = "//m:subject[@authority='lcsh']/m:geographic"
+    mods = etree.parse(mods_file)
+    geo_subj = mods.xpath(xpath, namespaces=nsmap)
+    return geo_subj[0].text if geo_subj else None
+
+
+def get_query(loc_name, locmap, locmap_file, geocoder):
+    """
+    Return the name to send to the geocoder for `loc_name` (None if the
+    location map gives its coordinates), the coordinates from the
+    location map and the list of sources used.
+    """
+    # list of sources (location map or geocoder service)
+    # use to lookup coordinates
+    sources = []
+    query = loc_name
+
+    if loc_name in locmap:
+        val = locmap[loc_name]
+        logging.debug("locmap[%s]: %s", loc_name, val)
+        sources.append(locmap_file)
+        if isinstance(val, list):
+            return None, val, sources
+        query = val
+
+    sources.append(geocoder)
+    return query, None, sources
+
+
+def make_coord(loc_name, coord, sources, geocoder):
+    """Return the coordinates dict for `loc_name` or None."""
+    if not coord:
         print(
             f"Couldn't find coordinates for {loc_name} "
-            f"using {args.geocoder.capitalize()} Maps API",
+            f"using {geocoder.capitalize()} Maps API",
             file=sys.stderr,
         )
-        exit(1)
-    return [location.latitude, location.longitude]
+        return None
+
+    lat, lng = coord
+    return {
+        "location": loc_name,
+        "latitude": lat,
+        "longitude": lng,
+        "sources": sources,
+    }
+
+
+def resolve(
+    loc_name, locmap, locmap_file, geocoder, cache=None, offline=False
+):
+    """Return the coordinates dict for `loc_name` or None."""
+    query, coord, sources = get_query(loc_name, locmap, locmap_file, geocoder)
+    if query:
+        coord = lookup_coord(query, geocoder, cache, offline)
+    return make_coord(loc_name, coord, sources, geocoder)
+
+
+def write_coord(coord, coord_file):
+    # Print coordinates to stdout or a file
+    if not coord_file or coord_file == "-":
+        print(json.dumps(coord, indent=2, ensure_ascii=False))
+    else:
+        with open(coord_file, "w", encoding="utf-8") as outfile:
+            json.dump(coord, outfile, indent=2, ensure_ascii=False)
+
+
+def get_object_id(mods_file):
+    """Return the object id from a MODS filename like ID_mods.xml."""
+    basename = os.path.basename(mods_file)
+    for suffix in ("_mods.xml", ".xml"):
+        if basename.endswith(suffix):
+            return basename[: -len(suffix)]
+    return basename
+
+
+def find_wip_mods(wip_dir, book_ids=None):
+    """
+    Yield the MODS file and coordinates file of each book in a wip/se
+    directory, or only of the books in `book_ids`.
+    """
+    if not book_ids:
+        book_ids = sorted(
+            entry.name for entry in os.scandir(wip_dir) if entry.is_dir()
+        )
+    for book_id in book_ids:
+        book_dir = os.path.join(wip_dir, book_id)
+        mods_files = sorted(
+            glob.glob(os.path.join(book_dir, "data", "*_mods.xml"))
+        )
+        if not mods_files:
+            logging.warning("No MODS file found for %s", book_id)
+            continue
+        coord_file = os.path.join(book_dir, "aux", f"{book_id}_geo_coord.json")
+        yield mods_files[0], coord_file
+
+
+def read_list(list_file):
+    """Return the non-blank lines of `list_file` ("-" for stdin)."""
+    if list_file == "-":
+        lines = sys.stdin.readlines()
+    else:
+        with open(list_file) as f:
+            lines = f.readlines()
+    return [line.strip() for line in lines if line.strip()]
+
+
+def run_batch(books, args, locmap, locmap_file, cache):
+    """
+    Look up coordinates for many MODS files at once.
+
+    `books` is a list of MODS files and the coordinates files to write,
+    or None to print the coordinates to stdout as one JSON object per
+    line. Each distinct location is only resolved once.
+
+    Returns the number of MODS files without coordinates.
+    """
+    if not args.force:
+        books = [
+            (mods_file, coord_file)
+            for mods_file, coord_file in books
+            if not (coord_file and os.path.exists(coord_file))
+        ]
+
+    locations = []
+    for mods_file, coord_file in books:
+        try:
+            loc_name = get_location(mods_file)
+        except (OSError, etree.XMLSyntaxError) as e:
+            logging.warning("Can't read %s: %s", mods_file, e)
+            loc_name = None
+        logging.debug("Location %s: %s", mods_file, loc_name)
+        locations.append((mods_file, coord_file, loc_name))
+
+    queries = {}
+    for _, _, loc_name in locations:
+        if loc_name and loc_name not in queries:
+            queries[loc_name] = get_query(
+                loc_name, locmap, locmap_file, args.geocoder
+            )
+    logging.debug(
+        "%d unique locations in %d MODS files", len(queries), len(books)
+    )
+
+    found = lookup_many(
+        sorted(set(q for q, _, _ in queries.values() if q)),
+        args.geocoder,
+        cache,
+        offline=args.offline,
+        jobs=args.jobs,
+        min_delay=args.min_delay,
+    )
+
+    coords = {}
+    for loc_name, (query, coord, sources) in queries.items():
+        if query:
+            coord = found.get(query)
+        coords[loc_name] = make_coord(loc_name, coord, sources, args.geocoder)
+
+    num_missing = 0
+    for mods_file, coord_file, loc_name in locations:
+        coord = coords.get(loc_name)
+        if not coord:
+            if not loc_name:
+                print(
+                    f"No geographic subject found in {mods_file}",
+                    file=sys.stderr,
+                )
+            num_missing += 1
+            continue
+        if coord_file:
+            write_coord(coord, coord_file)
+        else:
+            print(
+                json.dumps(
+                    {"mods_file": mods_file, **coord}, ensure_ascii=False
+                )
+            )
+    return num_missing
 
 
 def main():
     parser = argparse.ArgumentParser(
-        description="Get geographic coordinates from MODS subject"
+        description="Get geographic coordinates from MODS subject",
+        usage=(
+            "%(prog)s [options] MODS_FILE [COORD_FILE]\n"
+            "       %(prog)s [options] --batch [-l LIST] [MODS_FILE...]\n"
+            "       %(prog)s [options] --wip-dir WIP_DIR [BOOK_ID...]"
+        ),
     )
     parser.add_argument(
-        "mods_file", metavar="MODS_FILE", help="Input MODS file"
-    )
-    parser.add_argument(
-        "coord_file",
-        metavar="COORD_FILE",
-        nargs="?",
-        help="Output JSON coordinates file",
+        "files",
+        metavar="MODS_FILE [COORD_FILE]",
+        nargs="*",
+        help=(
+            "Input MODS file and optional output JSON coordinates file, "
+            "or book ids with --wip-dir"
+        ),
     )
     parser.add_argument(
         "-d", "--debug", help="Enable debugging messages", action="store_true"
@@ -67,8 +426,93 @@ def main():
         default="nominatim",
         help="Geocoder module for map requests",
     )
+    parser.add_argument(
+        "-b",
+        "--batch",
+        action="store_true",
+        help="Look up coordinates for every MODS_FILE given",
+    )
+    parser.add_argument(
+        "-l",
+        "--list",
+        metavar="FILE",
+        help="Batch mode, read MODS files from FILE ('-' for stdin)",
+    )
+    parser.add_argument(
+        "-w",
+        "--wip-dir",
+        help=(
+            "Batch mode, write BOOK_ID/aux/BOOK_ID_geo_coord.json for "
+            "books in this wip/se directory"
+        ),
+    )
+    parser.add_argument(
+        "-o",
+        "--output-dir",
+        help=(
+            "In batch mode, write ID_geo_coord.json files to this "
+            "directory instead of printing them"
+        ),
+    )
+    parser.add_argument(
+        "-f",
+        "--force",
+        action="store_true",
+        help="In batch mode, overwrite existing coordinates files",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=4,
+        help="Concurrent geocoder requests in batch mode (default: 4)",
+    )
+    parser.add_argument(
+        "--min-delay",
+        type=float,
+        metavar="SECS",
+        help="Minimum seconds between geocoder requests in batch mode",
+    )
+    parser.add_argument(
+        "--offline",
+        action="store_true",
+        help="Only use locmap.yaml and the cache, never query the geocoder",
+    )
+    parser.add_argument(
+        "--cache",
+        default=CACHE_FILE,
+        help="Geocoder cache file (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--no-cache",
+        action="store_true",
+        help="Always query the geocoder service",
+    )
+    parser.add_argument(
+        "--cache-ttl",
+        type=float,
+        default=180,
+        metavar="DAYS",
+        help="Days to keep cached coordinates (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--negative-ttl",
+        type=float,
+        default=7,
+        metavar="DAYS",
+        help=(
+            "Days to remember locations the geocoder couldn't find "
+            "(default: %(default)s)"
+        ),
+    )
     args = parser.parse_args()
 
+    batch = args.batch or args.list or args.wip_dir
+    if not batch and not 1 <= len(args.files) <= 2:
+        parser.error("expected a MODS file and optional coordinates file")
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
     if args.debug:
         logging.getLogger().setLevel(logging.DEBUG)
 
@@ -82,72 +526,66 @@ def main():
     #  available, provide coordinates.
     locmap_file = os.path.join(app_home, "locmap.yaml")
 
-    # User agent str for calls to web service
-    geocoder_args = {"user_agent": "dlts_geo_app/0.1"}
-
     # Make sure api key is set if service requires it
     api_key = os.environ.get("MAPS_API_KEY")
-    if args.geocoder in ["google"]:
-        if api_key:
-            geocoder_args["api_key"] = api_key
-        else:
+    if args.geocoder in ["google"] and not args.offline:
+        if not api_key:
             print(
                 "Must set envar MAPS_API_KEY for %s" % args.geocoder,
                 file=sys.stderr,
             )
             exit(1)
 
-    nsmap = {"m": "http://www.loc.gov/mods/v3"}
-    xpath = "//m:subject[@authority='lcsh']/m:geographic"
+    with open(locmap_file) as f:
+        locmap = yaml.full_load(f) or {}
+
+    cache = None
+    if not args.no_cache:
+        cache = GeocodeCache(
+            args.cache,
+            args.cache_ttl * ONE_DAY_IN_SECS,
+            args.negative_ttl * ONE_DAY_IN_SECS,
+        )
+
+    if batch:
+        if args.wip_dir:
+            books = list(find_wip_mods(args.wip_dir, args.files))
+        else:
+            mods_files = args.files
+            if args.list:
+                mods_files += read_list(args.list)
+            books = []
+            for mods_file in mods_files:
+                coord_file = None
+                if args.output_dir:
+                    coord_file = os.path.join(
+                        args.output_dir,
+                        f"{get_object_id(mods_file)}_geo_coord.json",
+                    )
+                books.append((mods_file, coord_file))
+        num_missing = run_batch(books, args, locmap, locmap_file, cache)
+        exit(1 if num_missing else 0)
+
+    mods_file = args.files[0]
+    coord_file = args.files[1] if len(args.files) > 1 else None
 
     # Get geographic subject from MODS
-    mods = etree.parse(args.mods_file)
-    geo_subj = mods.xpath(xpath, namespaces=nsmap)
-    if geo_subj:
-        loc_name = geo_subj[0].text
-    else:
+    loc_name = get_location(mods_file)
+    if not loc_name:
         print("No geographic subject found in MODS.", file=sys.stderr)
         exit(1)
 
     logging.debug("Location: %s", loc_name)
 
-    with open(locmap_file) as f:
-        locmap = yaml.full_load(f) or {}
-
-    # list of sources (location map or geocoder service)
-    # use to lookup coordinates
-    sources = []
-
-    # Get coordinates from location map or by
-    # querying geocoder service
-    if loc_name in locmap:
-        val = locmap[loc_name]
-        logging.debug("locmap[%s]: %s", loc_name, val)
-        sources.append(locmap_file)
-        if isinstance(val, list):
-            lat, lng = val
-        else:
-            lat, lng = lookup_coord(val, args.geocoder)
-            sources.append(args.geocoder)
-    else:
-        lat, lng = lookup_coord(loc_name, args.geocoder)
-        sources.append(args.geocoder)
-
-    coord = {
-        "location": loc_name,
-        "latitude": lat,
-        "longitude": lng,
-        "sources": sources,
-    }
+    coord = resolve(
+        loc_name, locmap, locmap_file, args.geocoder, cache, args.offline
+    )
+    if not coord:
+        exit(1)
 
     logging.debug("Coordinates %s", coord)
 
-    # Print coordinates to stdout or a file
-    if not args.coord_file or args.coord_file == "-":
-        print(json.dumps(coord, indent=2, ensure_ascii=False))
-    else:
-        with open(args.coord_file, "w", encoding="utf-8") as outfile:
-            json.dump(coord, outfile, indent=2, ensure_ascii=False)
+    write_coord(coord, coord_file)
 
 
 if __name__ == "__main__":
@@ -1,9 +1,15 @@
 #!/usr/bin/python3
 
 import argparse
+import json
 import logging
+import queue
 import sys
 import os
+import pdf_assemble
+import tempfile
+import time
+from concurrent.futures import ThreadPoolExecutor, as_completed
 from pathlib import Path
 from typing import List
 
@@ -23,6 +29,269 @@ def get_hocr_files(aux_dir: Path) -> List[Path]:
     return sorted(aux_dir.glob("*.hocr"))
 
 
+class BookError(Exception):
+    """A book whose inputs can't be turned into PDFs."""
+
+
+def file_stamp(path: Path) -> List[int]:
+    st = path.stat()
+    return [st.st_size, st.st_mtime_ns]
+
+
+def read_manifest(manifest_file: Path) -> dict:
+    try:
+        with open(manifest_file) as f:
+            return json.load(f)
+    except (OSError, ValueError):
+        return {}
+
+
+def write_manifest(manifest_file: Path, manifest: dict):
+    fd, tmp_file = tempfile.mkstemp(
+        dir=manifest_file.parent, prefix=".", suffix=".tmp"
+    )
+    with os.fdopen(fd, "w") as f:
+        json.dump(manifest, f, indent=2, sort_keys=True)
+    os.replace(tmp_file, manifest_file)
+
+
+def update_book(
+    book_id: str,
+    aux_dir: Path,
+    dmaker_imgs: List[Path],
+    hocr_files: List[Path],
+    max_workers: int,
+    overwrite: bool,
+) -> int:
+    """
+    Regenerate only the pages of a book whose inputs changed.
+
+    Each page's PDFs are kept in aux/<book_id>_pages and merged into
+    the book PDFs. The sizes and mtimes of the inputs they were made
+    from are recorded in aux/<book_id>_pdfs.json. Every TIFF and hOCR
+    file is still listed and stat'ed, but a book whose inputs haven't
+    changed is skipped without generating or merging any PDFs.
+
+    Returns the number of pages regenerated.
+    """
+    pages_dir = aux_dir / f"{book_id}_pages"
+    manifest_file = aux_dir / f"{book_id}_pdfs.json"
+    manifest = {} if overwrite else read_manifest(manifest_file)
+    old_pages = manifest.get("pages", {})
+    profiles = manifest.get("profiles", [])
+
+    pages = {
+        img.stem: {"tif": file_stamp(img), "hocr": file_stamp(hocr)}
+        for img, hocr in zip(dmaker_imgs, hocr_files)
+    }
+    changed = [
+        (img, hocr)
+        for img, hocr in zip(dmaker_imgs, hocr_files)
+        if old_pages.get(img.stem) != pages[img.stem]
+        or not all(
+            (pages_dir / f"{img.stem}_{profile}.pdf").exists()
+            for profile in profiles
+        )
+    ]
+    outputs = [aux_dir / f"{book_id}_{profile}.pdf" for profile in profiles]
+    if (
+        not changed
+        and set(old_pages) == set(pages)
+        and profiles
+        and all(output.exists() for output in outputs)
+    ):
+        logging.info(f"{book_id}: unchanged, skipping")
+        return 0
+
+    logging.info(
+        f"{book_id}: regenerating {len(changed)} of {len(pages)} page(s)"
+    )
+    pages_dir.mkdir(exist_ok=True)
+
+    # pages that were removed from the book
+    for stem in set(old_pages) - set(pages):
+        for pdf_file in pages_dir.glob(f"{stem}_*.pdf"):
+            pdf_file.unlink()
+
+    with ThreadPoolExecutor(max_workers=max_workers) as executor:
+        futures = [
+            executor.submit(
+                generate_pdfs,
+                [img],
+                [hocr],
+                pages_dir / img.stem,
+                max_workers=1,
+                overwrite=True,
+            )
+            for img, hocr in changed
+        ]
+        for future in as_completed(futures):
+            future.result()
+
+    # the profiles (e.g. hi and lo) generate_pdfs makes for each page
+    first_stem = dmaker_imgs[0].stem
+    profiles = sorted(
+        pdf_file.name[len(first_stem) + 1 : -len(".pdf")]
+        for pdf_file in pages_dir.glob(f"{first_stem}_*.pdf")
+    )
+    if not profiles:
+        raise BookError(f"No page PDFs generated in {pages_dir}")
+
+    for profile in profiles:
+        page_pdfs = [pages_dir / f"{stem}_{profile}.pdf" for stem in pages]
+        missing = [pdf_file for pdf_file in page_pdfs if not pdf_file.exists()]
+        if missing:
+            raise BookError(f"Missing page PDF {missing[0]}")
+        pdf_assemble.assemble(page_pdfs, aux_dir / f"{book_id}_{profile}.pdf")
+
+    write_manifest(manifest_file, {"pages": pages, "profiles": profiles})
+    return len(changed)
+
+
+def split_workers(jobs: int, num_slots: int) -> List[int]:
+    """Split a budget of `jobs` workers between `num_slots` books."""
+    return [
+        jobs // num_slots + (1 if i < jobs % num_slots else 0)
+        for i in range(num_slots)
+    ]
+
+
+def process_book(
+    rstar_dir: Path,
+    book_id: str,
+    max_workers: int,
+    overwrite: bool,
+    incremental: bool = False,
+) -> dict:
+    """
+    Generate the PDFs of one book and return its number of pages and
+    the number of pages regenerated.
+    """
+    book_dir = rstar_dir / "wip" / "se" / book_id
+    aux_dir = book_dir / "aux"
+
+    if not book_dir.exists():
+        raise BookError(f"book_dir does not exist: {book_dir}")
+
+    if not aux_dir.exists():
+        raise BookError(f"aux_dir does not exist: {aux_dir}")
+
+    dmaker_imgs = get_dmaker_images(aux_dir)
+    hocr_files = get_hocr_files(aux_dir)
+
+    if len(dmaker_imgs) != len(hocr_files):
+        raise BookError(
+            f"Page mismatch — {len(dmaker_imgs)} TIFF(s) vs"
+            f" {len(hocr_files)} HOCR file(s)."
+        )
+
+    if incremental:
+        if not dmaker_imgs:
+            raise BookError(f"No dmaker images in {aux_dir}")
+        rebuilt = update_book(
+            book_id, aux_dir, dmaker_imgs, hocr_files, max_workers, overwrite
+        )
+        return {"pages": len(dmaker_imgs), "rebuilt": rebuilt}
+
+    # log the listing as one message so books running in parallel
+    # don't interleave
+    lines = [f"\nBook ID: {book_id}", f"Book directory: {book_dir}"]
+    lines.append(f"  Dmaker images ({len(dmaker_imgs)}):")
+    lines.extend(f"    {img.name}" for img in dmaker_imgs)
+    lines.append(f"  HOCR files ({len(hocr_files)}):")
+    lines.extend(f"    {hocr.name}" for hocr in hocr_files)
+    lines.append("-" * 60)
+    logging.info("\n".join(lines))
+
+    output_base = aux_dir / book_id
+
+    generate_pdfs(
+        dmaker_imgs,
+        hocr_files,
+        output_base,
+        max_workers=max_workers,
+        overwrite=overwrite,
+    )
+    return {"pages": len(dmaker_imgs), "rebuilt": len(dmaker_imgs)}
+
+
+def run_books(
+    rstar_dir: Path,
+    book_ids: List[str],
+    jobs: int,
+    max_books: int,
+    overwrite: bool,
+    incremental: bool = False,
+) -> dict:
+    """
+    Process books in parallel, sharing a budget of `jobs` workers.
+
+    Up to `max_books` books run at once, and the budget is split evenly
+    between them for their page workers in `generate_pdfs`. Failures are
+    recorded per book instead of stopping the run.
+
+    Returns a dict mapping each book id to its pages, pages
+    regenerated, wall time in seconds and error message, if any.
+    """
+    num_slots = max(1, min(max_books, jobs, len(book_ids)))
+    slots = queue.Queue()
+    for workers in split_workers(jobs, num_slots):
+        slots.put(workers)
+
+    def run(book_id):
+        workers = slots.get()
+        start = time.monotonic()
+        result = {"pages": 0, "rebuilt": 0, "seconds": 0.0, "error": None}
+        try:
+            result.update(
+                process_book(
+                    rstar_dir, book_id, workers, overwrite, incremental
+                )
+            )
+        except Exception as e:
+            logging.debug(f"{book_id}: failed", exc_info=True)
+            result["error"] = str(e) or type(e).__name__
+            logging.error(f"{book_id}: {result['error']}")
+        finally:
+            slots.put(workers)
+        result["seconds"] = time.monotonic() - start
+        return result
+
+    results = {}
+    with ThreadPoolExecutor(max_workers=num_slots) as executor:
+        futures = {
+            executor.submit(run, book_id): book_id for book_id in book_ids
+        }
+        for future in as_completed(futures):
+            results[futures[future]] = future.result()
+    return results
+
+
+def print_report(results: dict, book_ids: List[str], wall_time: float):
+    """Log pages and wall time per book and a summary of failures."""
+    logging.info(
+        f"\n{'Book ID':<24} {'Pages':>8} {'Rebuilt':>8} {'Seconds':>10}"
+        "  Status"
+    )
+    for book_id in book_ids:
+        result = results[book_id]
+        status = "FAILED" if result["error"] else "ok"
+        logging.info(
+            f"{book_id:<24} {result['pages']:>8} {result['rebuilt']:>8}"
+            f" {result['seconds']:>10.1f}  {status}"
+        )
+    failed = [book_id for book_id in book_ids if results[book_id]["error"]]
+    num_pages = sum(result["pages"] for result in results.values())
+    logging.info(
+        f"{len(book_ids) - len(failed)}/{len(book_ids)} books, "
+        f"{num_pages} pages in {wall_time:.1f}s"
+    )
+    if failed:
+        logging.warning(f"{len(failed)} book(s) failed:")
+        for book_id in failed:
+            logging.warning(f"  {book_id}: {results[book_id]['error']}")
+
+
 def main():
     parser = argparse.ArgumentParser(
         description="Generate PDFs from dmaker TIFF and HOCR files."
@@ -55,6 +324,31 @@ def main():
         action="store_true",
         help="Force overwrite of existing output files.",
     )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help=(
+            "Total number of page workers shared by all books "
+            "(default: %(default)s)."
+        ),
+    )
+    parser.add_argument(
+        "-b",
+        "--max-books",
+        type=int,
+        help="Maximum number of books processed at once (default: --jobs).",
+    )
+    parser.add_argument(
+        "-i",
+        "--incremental",
+        action="store_true",
+        help=(
+            "Only regenerate pages whose TIFF or HOCR file changed since "
+            "the last incremental run, and skip unchanged books."
+        ),
+    )
     parser.add_argument(
         "book_ids",
         nargs="*",
@@ -62,6 +356,11 @@ def main():
     )
     args = parser.parse_args()
 
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+    if args.max_books is not None and args.max_books < 1:
+        parser.error("--max-books must be at least 1")
+
     log_level = logging.WARNING if args.quiet else logging.INFO
     logging.basicConfig(level=log_level, format="%(message)s")
 
@@ -89,50 +388,19 @@ def main():
             sys.exit(f"ERROR: No book IDs found in {se_dir}")
         logging.info(f"Discovered book IDs: {', '.join(book_ids)}")
 
-    for book_id in book_ids:
-        book_dir = rstar_dir / "wip" / "se" / book_id
-        aux_dir = book_dir / "aux"
-
-        if not book_dir.exists():
-            logging.error(f"{book_id}: book_dir does not exist: {book_dir}")
-            sys.exit(1)
-
-        if not aux_dir.exists():
-            logging.error(f"{book_id}: aux_dir does not exist: {aux_dir}")
-            sys.exit(1)
-
-        dmaker_imgs = get_dmaker_images(aux_dir)
-        hocr_files = get_hocr_files(aux_dir)
-
-        logging.info(f"\nBook ID: {book_id}")
-        logging.info(f"Book directory: {book_dir}")
-
-        logging.info(f"  Dmaker images ({len(dmaker_imgs)}):")
-        for img in dmaker_imgs:
-            logging.info(f"    {img.name}")
-
-        logging.info(f"  HOCR files ({len(hocr_files)}):")
-        for hocr in hocr_files:
-            logging.info(f"    {hocr.name}")
-
-        logging.info("-" * 60)
-
-        if len(dmaker_imgs) != len(hocr_files):
-            logging.error(
-                f"{book_id}: Page mismatch — {len(dmaker_imgs)} TIFF(s) vs"
-                f" {len(hocr_files)} HOCR file(s). Aborting."
-            )
-            sys.exit(1)
-
-        output_base = aux_dir / book_id
+    start = time.monotonic()
+    results = run_books(
+        rstar_dir,
+        book_ids,
+        args.jobs,
+        args.max_books or args.jobs,
+        args.overwrite,
+        args.incremental,
+    )
+    print_report(results, book_ids, time.monotonic() - start)
 
-        generate_pdfs(
-            dmaker_imgs,
-            hocr_files,
-            output_base,
-            max_workers=1,
-            overwrite=args.overwrite,
-        )
+    if any(result["error"] for result in results.values()):
+        sys.exit(1)
 
 
 if __name__ == "__main__":
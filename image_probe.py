@@ -0,0 +1,216 @@
+#!/usr/bin/python3
+#
+# Inspect page images without running ImageMagick.
+#
+# Dimensions, resolution and bit depth are read from the image
+# header.  Whether a page has a mostly white border is decided from a
+# small, downsampled decode of the image.  The module is used as a
+# library by the python scripts and as a batch command line tool by
+# the perl scripts, e.g.
+#
+#   image_probe.py --white --pattern '*_s.jpg' /path/to/aux
+#
+# prints one JSON object per image.
+
+import argparse
+import fnmatch
+import json
+import logging
+import os
+import PIL.Image
+import struct
+import sys
+
+
+IMAGE_EXTENSIONS = (".jpg", ".jpeg", ".jp2", ".png", ".tif", ".tiff")
+
+# bits per sample for each Pillow image mode
+BIT_DEPTH = {
+    "1": 1,
+    "L": 8,
+    "LA": 8,
+    "P": 8,
+    "RGB": 8,
+    "RGBA": 8,
+    "CMYK": 8,
+    "YCbCr": 8,
+    "LAB": 8,
+    "I;16": 16,
+    "I;16B": 16,
+    "I;16L": 16,
+    "I": 32,
+    "F": 32,
+}
+
+# longest side of the image used to check the page border
+PROBE_SIZE = 256
+
+# gray level at or above which a pixel is considered white
+WHITE_THRESHOLD = 240
+
+# fraction of border pixels that must be white for a white page
+WHITE_BORDER_RATIO = 0.5
+
+
+# libjpeg's luminance quantization table, which it scales to set the
+# quality of a JPEG
+STD_LUMINANCE_TABLE = (
+    16, 11, 10, 16, 24, 40, 51, 61,
+    12, 12, 14, 19, 26, 58, 60, 55,
+    14, 13, 16, 24, 40, 57, 69, 56,
+    14, 17, 22, 29, 51, 87, 80, 62,
+    18, 22, 37, 56, 68, 109, 103, 77,
+    24, 35, 55, 64, 81, 104, 113, 92,
+    49, 64, 78, 87, 103, 121, 120, 101,
+    72, 92, 95, 98, 112, 100, 103, 99,
+)  # fmt: skip
+
+
+def get_dpi(img):
+    """Return the (x, y) resolution of an opened image or None."""
+    dpi = img.info.get("dpi")
+    if not dpi:
+        return None
+    return tuple(round(float(d)) for d in dpi)
+
+
+def jpeg_quality(img):
+    """Estimate the quality an opened JPEG image was saved with.
+
+    The luminance table is compared with libjpeg's table at quality 50,
+    the same way ImageMagick estimates the quality it keeps when
+    resizing a JPEG. Returns None if `img` isn't a JPEG.
+    """
+    tables = getattr(img, "quantization", None)
+    if img.format != "JPEG" or not tables:
+        return None
+    scale = sum(tables[0]) * 100 / sum(STD_LUMINANCE_TABLE)
+    quality = (200 - scale) / 2 if scale <= 100 else 5000 / scale
+    return min(100, max(1, round(quality)))
+
+
+def has_white_border(img):
+    """Return True if most of the outermost pixels of `img` are white.
+
+    For JPEG files the image is decoded directly at a reduced size with
+    libjpeg's scaled decoding, so the full resolution image is never
+    held in memory. The image must not have been loaded yet.
+    """
+    img.draft("L", (PROBE_SIZE, PROBE_SIZE))
+    gray = img.convert("L")
+    gray.thumbnail((PROBE_SIZE, PROBE_SIZE))
+
+    width, height = gray.size
+    pixels = gray.load()
+    border = [pixels[x, y] for x in range(width) for y in (0, height - 1)]
+    border += [
+        pixels[x, y] for y in range(1, height - 1) for x in (0, width - 1)
+    ]
+    num_white = sum(1 for v in border if v >= WHITE_THRESHOLD)
+    return num_white >= len(border) * WHITE_BORDER_RATIO
+
+
+def probe(path, white=False):
+    """
+    Return basic properties of an image file.
+
+    Args:
+        path (str): Path to the image file.
+        white (bool): If True, also decide whether the page has a mostly
+            white border.
+
+    Returns:
+        dict: file, format, mode, width, height, dpi (tuple or None),
+        depth (bits per sample) and, if requested, white.
+    """
+    with PIL.Image.open(path) as img:
+        info = {
+            "file": path,
+            "format": img.format,
+            "mode": img.mode,
+            "width": img.width,
+            "height": img.height,
+            "dpi": get_dpi(img),
+            "depth": BIT_DEPTH.get(img.mode),
+        }
+        if white:
+            info["white"] = has_white_border(img)
+    return info
+
+
+def set_jpeg_density(path, dpi):
+    """Set the resolution of a JPEG file in place without decoding it.
+
+    Only the density fields of the JFIF header are rewritten, so the
+    image data is untouched. Returns False, leaving the file as is, if
+    it has no JFIF header to update.
+    """
+    with open(path, "r+b") as f:
+        header = f.read(18)
+        # SOI, APP0 marker, segment length, JFIF identifier, version
+        if header[:4] != b"\xff\xd8\xff\xe0" or header[6:11] != b"JFIF\0":
+            return False
+        f.seek(13)
+        # density units are dots per inch
+        f.write(struct.pack(">BHH", 1, dpi, dpi))
+    return True
+
+
+def collect_inputs(inputs, pattern=None):
+    """Expand directories in `inputs` to the image files they contain."""
+    for item in inputs:
+        if os.path.isdir(item):
+            for entry in sorted(os.scandir(item), key=lambda e: e.name):
+                if not entry.is_file():
+                    continue
+                if pattern:
+                    if not fnmatch.fnmatch(entry.name, pattern):
+                        continue
+                elif not entry.name.lower().endswith(IMAGE_EXTENSIONS):
+                    continue
+                yield entry.path
+        else:
+            yield item
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Print dimensions, resolution and depth of images"
+    )
+    parser.add_argument(
+        "inputs", nargs="+", metavar="PATH", help="image file or directory"
+    )
+    parser.add_argument(
+        "-w",
+        "--white",
+        action="store_true",
+        help="Check if pages have a mostly white border",
+    )
+    parser.add_argument(
+        "-p",
+        "--pattern",
+        help="Only inspect files in directories matching this glob",
+    )
+    parser.add_argument(
+        "-d", "--debug", help="Enable debugging messages", action="store_true"
+    )
+    args = parser.parse_args()
+
+    level = logging.DEBUG if args.debug else logging.WARNING
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=level)
+
+    exit_code = 0
+    for path in collect_inputs(args.inputs, args.pattern):
+        try:
+            info = probe(path, white=args.white)
+        except (OSError, PIL.Image.DecompressionBombError) as e:
+            logging.debug("Can't read %s", path, exc_info=True)
+            info = {"file": path, "error": str(e)}
+            exit_code = 1
+        print(json.dumps(info, ensure_ascii=False), flush=True)
+
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
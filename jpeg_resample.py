@@ -0,0 +1,229 @@
+#!/usr/bin/python3
+#
+# Resample scanned JPEG pages to a lower resolution.
+#
+# The "quality" method runs ImageMagick's -resample on the full
+# resolution image.  For reductions of 2x or more, the "speed" method
+# has libjpeg decode the image straight to 1/2, 1/4 or 1/8 of its size
+# with its scaled IDCT (Pillow's draft mode) and then only does a
+# small Lanczos resample to the final size.  The module is used as a
+# library by shrink-aco-pdf.py and as a benchmark to pick the method
+# for a collection, e.g.
+#
+#   jpeg_resample.py --dpi 72 page1.jpg page2.jpg
+#
+# prints the wall time of each method, the size of its output and its
+# SSIM against a Lanczos resample of the fully decoded image.
+
+import argparse
+import image_probe
+import logging
+import os
+import PIL.Image
+import subprocess
+import sys
+import tempfile
+import time
+
+
+METHODS = ("quality", "speed")
+
+# ImageMagick's default quality when the input isn't a JPEG
+JPEG_QUALITY = 92
+
+# smallest reduction worth decoding at a reduced size
+MIN_DRAFT_REDUCTION = 2
+
+
+def do_cmd(cmdlist, **kwargs):
+    cmd = list(map(str, cmdlist))
+    logging.debug("Running command: %s", " ".join(cmd))
+    try:
+        process = subprocess.run(cmd, check=True, **kwargs)
+    except Exception as e:
+        logging.exception(e)
+        raise
+    return process
+
+
+def target_size(size, src_dpi, dpi):
+    return tuple(max(1, round(n * dpi / src_dpi)) for n in size)
+
+
+def magick_resample(src_file, src_dpi, dpi, output_file):
+    do_cmd([
+        "convert",
+        "-density",
+        src_dpi,
+        "-units",
+        "PixelsPerInch",
+        src_file,
+        "-resample",
+        dpi,
+        "-density",
+        dpi,
+        "-units",
+        "PixelsPerInch",
+        output_file,
+    ])
+
+
+def draft_resample(src_file, src_dpi, dpi, output_file):
+    with PIL.Image.open(src_file) as img:
+        # keep the quality of the source, like ImageMagick does
+        quality = image_probe.jpeg_quality(img) or JPEG_QUALITY
+        size = target_size(img.size, src_dpi, dpi)
+        # libjpeg picks the smallest scale that is still at least
+        # `size`, so the final resample never enlarges the image
+        img.draft(img.mode, size)
+        logging.debug(
+            "Decoded %s at %dx%d for %dx%d", src_file, *img.size, *size
+        )
+        resized = img.resize(size, PIL.Image.LANCZOS)
+    resized.save(output_file, quality=quality, dpi=(dpi, dpi))
+
+
+def resample(src_file, src_dpi, dpi, output_file, method="quality"):
+    """
+    Resample `src_file` from `src_dpi` to `dpi` and write the result to
+    `output_file` as a JPEG. With the "speed" method, JPEGs reduced by
+    MIN_DRAFT_REDUCTION or more are decoded at a reduced size; anything
+    else is resampled by ImageMagick.
+
+    Returns the method used.
+    """
+    if method == "speed" and src_dpi >= dpi * MIN_DRAFT_REDUCTION:
+        with PIL.Image.open(src_file) as img:
+            is_jpeg = img.format == "JPEG"
+        if is_jpeg:
+            draft_resample(src_file, src_dpi, dpi, output_file)
+            return "speed"
+    magick_resample(src_file, src_dpi, dpi, output_file)
+    return "quality"
+
+
+def ssim(img1, img2):
+    """
+    Return the mean structural similarity of two images of the same
+    size, compared in grayscale with an 11x11 gaussian window.
+    """
+    # numpy is only needed for benchmarking
+    import numpy as np
+
+    a = np.asarray(img1.convert("L"), dtype=np.float64)
+    b = np.asarray(img2.convert("L"), dtype=np.float64)
+
+    x = np.arange(11) - 5
+    window = np.exp(-(x**2) / (2 * 1.5**2))
+    window /= window.sum()
+
+    def blur(m):
+        rows = m.shape[0] - 10
+        m = sum(w * m[i : i + rows] for i, w in enumerate(window))
+        cols = m.shape[1] - 10
+        return sum(w * m[:, i : i + cols] for i, w in enumerate(window))
+
+    c1, c2 = (0.01 * 255) ** 2, (0.03 * 255) ** 2
+    mu_a, mu_b = blur(a), blur(b)
+    var_a = blur(a * a) - mu_a**2
+    var_b = blur(b * b) - mu_b**2
+    cov = blur(a * b) - mu_a * mu_b
+    ssim_map = ((2 * mu_a * mu_b + c1) * (2 * cov + c2)) / (
+        (mu_a**2 + mu_b**2 + c1) * (var_a + var_b + c2)
+    )
+    return float(ssim_map.mean())
+
+
+def benchmark(src_file, src_dpi, dpi, tmpdir):
+    """
+    Return the (method, seconds, output bytes, ssim) of each method for
+    one image.
+    """
+    with PIL.Image.open(src_file) as img:
+        size = target_size(img.size, src_dpi, dpi)
+        reference = img.resize(size, PIL.Image.LANCZOS)
+
+    results = []
+    for method in METHODS:
+        output_file = os.path.join(tmpdir, f"{method}.jpg")
+        start = time.perf_counter()
+        used = resample(src_file, src_dpi, dpi, output_file, method)
+        seconds = time.perf_counter() - start
+        num_bytes = os.path.getsize(output_file)
+        if used != method:
+            logging.warning("Can't use %s method for %s", method, src_file)
+        with PIL.Image.open(output_file) as output:
+            # ImageMagick may round the size differently
+            if output.size != size:
+                output = output.resize(size, PIL.Image.LANCZOS)
+            score = ssim(reference, output)
+        results.append((method, seconds, num_bytes, score))
+    return results
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description=(
+            "Compare wall time and SSIM of the jpeg resampling methods"
+        )
+    )
+    parser.add_argument("images", nargs="+", metavar="IMAGE")
+    parser.add_argument(
+        "--dpi",
+        type=int,
+        default=72,
+        help="Target resolution (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--src-dpi",
+        type=int,
+        help="Resolution of the images if not set in their headers",
+    )
+    parser.add_argument(
+        "-d", "--debug", help="Enable debugging messages", action="store_true"
+    )
+    args = parser.parse_args()
+
+    level = logging.DEBUG if args.debug else logging.WARNING
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=level)
+
+    totals = {method: [0.0, 0, 0.0] for method in METHODS}
+    num_images = 0
+    print(
+        f"{'Image':<40} {'Method':<8} {'Seconds':>8} {'Bytes':>10} "
+        f"{'SSIM':>7}"
+    )
+    with tempfile.TemporaryDirectory() as tmpdir:
+        for src_file in args.images:
+            info = image_probe.probe(src_file)
+            src_dpi = args.src_dpi or (info["dpi"] or [None])[0]
+            if not src_dpi:
+                logging.error("No resolution for %s, use --src-dpi", src_file)
+                continue
+            try:
+                results = benchmark(src_file, src_dpi, args.dpi, tmpdir)
+            except (OSError, subprocess.CalledProcessError) as e:
+                logging.error("Can't benchmark %s: %s", src_file, e)
+                continue
+            name = os.path.basename(src_file)
+            for method, seconds, num_bytes, score in results:
+                print(
+                    f"{name:<40} {method:<8} {seconds:8.3f} "
+                    f"{num_bytes:10d} {score:7.4f}"
+                )
+                totals[method][0] += seconds
+                totals[method][1] += num_bytes
+                totals[method][2] += score
+            num_images += 1
+
+    if not num_images:
+        sys.exit(1)
+    for method, (seconds, num_bytes, score) in totals.items():
+        print(
+            f"{'Total/mean':<40} {method:<8} {seconds:8.3f} "
+            f"{num_bytes:10d} {score / num_images:7.4f}"
+        )
+
+
+if __name__ == "__main__":
+    main()
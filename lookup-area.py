@@ -2,9 +2,12 @@
 
 import argparse
 import countryinfo
+import functools
 import json
 import os
+import pickle
 import sys
+import tempfile
 
 # directory for natural earth map files
 DATA_DIR = "/usr/share/natural-earth-map-data"
@@ -12,6 +15,13 @@ DATA_DIR = "/usr/share/natural-earth-map-data"
 # geojson data file for world cities
 CITY_FILE = "ne_50m_populated_places.geojson"
 
+# prebuilt index of city areas, rebuilt whenever the geojson changes
+CACHE_DIR = os.path.join(
+    os.environ.get("XDG_CACHE_HOME", os.path.expanduser("~/.cache")),
+    "book-publisher",
+)
+CITY_INDEX = "city_area.pickle"
+
 # number of sq kilometers per square mile
 RATIO_KM2_TO_MILE2 = 1.609344**2
 
@@ -20,6 +30,7 @@ def convert_km2_to_mile2(km2):
     return float(km2) / RATIO_KM2_TO_MILE2
 
 
+@functools.lru_cache(maxsize=None)
 def country_area(location):
     cinfo = countryinfo.CountryInfo(location)
     try:
@@ -28,29 +39,92 @@ def country_area(location):
         return None
 
 
-def city_area(location):
-    app_home = os.path.dirname(os.path.abspath(sys.argv[0]))
-    city_file = os.path.join(DATA_DIR, CITY_FILE)
+def build_city_index(city_file):
+    """Return a dict mapping city names to their area in sq km."""
     area = {}
     with open(city_file) as f:
         city_data = json.load(f)
     for feature in city_data["features"]:
         prop = feature["properties"]
         area[prop["NAME"]] = prop["MAX_AREAKM"]
-    return area.get(location)
+    return area
+
+
+def load_city_index(city_file, cache_dir=CACHE_DIR):
+    """
+    Return the city area index for `city_file`, loading it from a
+    pickle in `cache_dir` unless the geojson file has changed since it
+    was written.
+    """
+    st = os.stat(city_file)
+    stamp = (os.path.abspath(city_file), st.st_size, st.st_mtime_ns)
+    index_file = os.path.join(cache_dir, CITY_INDEX)
+    try:
+        with open(index_file, "rb") as f:
+            index = pickle.load(f)
+        if index["stamp"] == stamp:
+            return index["area"]
+    except (OSError, EOFError, KeyError, pickle.UnpicklingError):
+        pass
+
+    area = build_city_index(city_file)
+    try:
+        os.makedirs(cache_dir, exist_ok=True)
+        fd, tmp_file = tempfile.mkstemp(dir=cache_dir, suffix=".tmp")
+        with os.fdopen(fd, "wb") as f:
+            pickle.dump({"stamp": stamp, "area": area}, f)
+        os.replace(tmp_file, index_file)
+    except OSError as e:
+        print(f"Can't write {index_file}: {e}", file=sys.stderr)
+    return area
+
+
+@functools.lru_cache(maxsize=None)
+def city_index():
+    return load_city_index(os.path.join(DATA_DIR, CITY_FILE))
+
+
+def city_area(location):
+    return city_index().get(location)
+
+
+def lookup_area(location, miles2=False):
+    area = country_area(location) or city_area(location)
+    if area and miles2:
+        area = convert_km2_to_mile2(area)
+    return area
 
 
 def main():
     parser = argparse.ArgumentParser(description="Lookup area")
-    parser.add_argument("location")
+    parser.add_argument("location", nargs="?")
     parser.add_argument("-m", "--miles2", action="store_true")
+    parser.add_argument(
+        "-b",
+        "--batch",
+        action="store_true",
+        help=(
+            "Read locations from stdin, one per line, and print "
+            "LOCATION<TAB>AREA for each (AREA empty if unknown)"
+        ),
+    )
     args = parser.parse_args()
 
-    area = country_area(args.location) or city_area(args.location)
+    if args.batch:
+        for line in sys.stdin:
+            location = line.strip()
+            if not location:
+                continue
+            area = lookup_area(location, args.miles2)
+            print(f"{location}\t{area or ''}", flush=True)
+        return
+
+    if not args.location:
+        parser.error("location is required without --batch")
+
+    area = lookup_area(args.location, args.miles2)
 
     if area:
-        if args.miles2:
-            area = convert_km2_to_mile2(area)
         print(area)
     else:
         exit(1)
@@ -4,35 +4,144 @@
 #
 # Modified version of this stackoverflow answer:
 # https://stackoverflow.com/a/11315257/13631441
+#
+# The inputs are streamed with iterparse so only one top level
+# feature is held in memory at a time.  The header and styles of the
+# first document are copied to the output followed by the placemarks
+# of every document.
 
 from xml.etree import ElementTree as ET
+from xml.sax.saxutils import quoteattr
+import argparse
 import sys
 
 
-def main():
-    if len(sys.argv) < 3:
-        print(
-            f"Usage: {sys.argv[0]} KML_FILE KML_FILE [KML_FILE]...",
-            file=sys.stderr,
-        )
-        exit(1)
+KML_NS = "http://www.opengis.net/kml/2.2"
+KML_PREFIX = f"{{{KML_NS}}}"
+
+# elements sharing the id space referenced by styleUrl
+STYLE_TAGS = ("Style", "StyleMap")
+
+
+def local_name(tag):
+    return tag[len(KML_PREFIX) :] if tag.startswith(KML_PREFIX) else tag
+
+
+def strip_ns(elem):
+    """Move `elem` and its KML descendants to the default namespace."""
+    for e in elem.iter():
+        if isinstance(e.tag, str):
+            e.tag = local_name(e.tag)
+
+
+def format_attrs(elem):
+    return "".join(
+        f" {k}={quoteattr(v)}"
+        for k, v in elem.attrib.items()
+        if not k.startswith("{")
+    )
+
 
-    nsmap = {"k": "http://www.opengis.net/kml/2.2"}
+class KmlMerger:
+    """
+    Write the Document children of several KML files to `out` as one
+    KML document.
 
-    ET.register_namespace("", nsmap["k"])
+    All children of the first document are copied, only Placemarks of
+    the others. With `dedupe`, Placemarks with an id already written
+    are skipped, and Styles of the other documents are copied unless a
+    style with the same id was already written.
+    """
 
-    first = {}
+    def __init__(self, out, dedupe=False):
+        self.out = out
+        self.dedupe = dedupe
+        self.started = False
+        self.placemark_ids = set()
+        self.style_ids = set()
 
-    for filename in sys.argv[1:]:
-        kml = ET.parse(filename).getroot()
-        if not first:
-            first["root"] = kml
-            first["doc_node"] = kml.find("./k:Document", nsmap)
-        else:
-            placemarks = kml.findall("./k:Document/k:Placemark", nsmap)
-            first["doc_node"].extend(placemarks)
+    def keep(self, name, elem_id, first):
+        if name == "Placemark":
+            if self.dedupe and elem_id:
+                if elem_id in self.placemark_ids:
+                    return False
+                self.placemark_ids.add(elem_id)
+            return True
+        if name in STYLE_TAGS and elem_id:
+            if not first and (not self.dedupe or elem_id in self.style_ids):
+                return False
+            self.style_ids.add(elem_id)
+            return True
+        return first
 
-    print(ET.tostring(first["root"], encoding="unicode"))
+    def write_header(self, root, doc):
+        self.out.write(f'<kml xmlns="{KML_NS}"{format_attrs(root)}>\n')
+        self.out.write(f"<Document{format_attrs(doc)}>\n")
+        self.started = True
+
+    def write_footer(self):
+        self.out.write("</Document>\n</kml>\n")
+
+    def merge(self, filename):
+        first = not self.started
+        root = doc = None
+        depth = 0
+        events = ("start", "end", "start-ns")
+        for event, elem in ET.iterparse(filename, events=events):
+            if event == "start-ns":
+                prefix, uri = elem
+                if prefix:
+                    ET.register_namespace(prefix, uri)
+                continue
+
+            if event == "start":
+                depth += 1
+                if depth == 1:
+                    root = elem
+                elif depth == 2 and elem.tag == KML_PREFIX + "Document":
+                    doc = elem
+                    if first:
+                        self.write_header(root, doc)
+                continue
+
+            depth -= 1
+            if elem is doc:
+                doc = None
+            if depth != 2 or doc is None:
+                continue
+
+            # elem is a child of Document
+            if self.keep(local_name(elem.tag), elem.get("id"), first):
+                strip_ns(elem)
+                elem.tail = "\n"
+                self.out.write(ET.tostring(elem, encoding="unicode"))
+            doc.remove(elem)
+
+        if first and not self.started:
+            raise ValueError(f"{filename}: no KML Document element")
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Merge KML files")
+    parser.add_argument("files", nargs="+", metavar="KML_FILE")
+    parser.add_argument(
+        "--dedupe",
+        action="store_true",
+        help=(
+            "Skip Placemarks whose id was already seen and merge Style "
+            "definitions from all files by id"
+        ),
+    )
+    args = parser.parse_args()
+
+    merger = KmlMerger(sys.stdout, dedupe=args.dedupe)
+    try:
+        for filename in args.files:
+            merger.merge(filename)
+    except (OSError, ET.ParseError, ValueError) as e:
+        print(f"Can't merge {filename}: {e}", file=sys.stderr)
+        exit(1)
+    merger.write_footer()
 
 
 if __name__ == "__main__":
@@ -0,0 +1,320 @@
+#!/usr/bin/python3
+#
+# Run Tesseract OCR without reloading the language model for each page.
+#
+# Engines are created through the Tesseract C API (libtesseract via
+# ctypes) once per language in each process and reused for every page.
+# A page is recognized once and rendered to any of the pdf, hocr and
+# txt formats in the same pass.  If libtesseract can't be loaded the
+# tesseract command line tool is used instead, which also writes all
+# formats from a single run.
+#
+# The module is used as a library by the python scripts and as a
+# batch command line tool by the perl scripts, e.g.
+#
+#   ocr_engine.py -l ara+eng -f txt,hocr -o /path/to/aux page*.tif
+#
+# writes page1.txt, page1.hocr, ... to /path/to/aux.
+
+from concurrent.futures import ProcessPoolExecutor
+import argparse
+import ctypes
+import ctypes.util
+import logging
+import os
+import subprocess
+import sys
+
+
+FORMATS = ("pdf", "hocr", "txt")
+
+LIBRARY_NAMES = ("libtesseract.so.5", "libtesseract.so.4")
+
+# engines of this process, by language
+_engines = {}
+
+
+class OcrError(Exception):
+    pass
+
+
+def load_library():
+    """Load libtesseract and declare the C API functions used."""
+    path = ctypes.util.find_library("tesseract")
+    names = (path,) + LIBRARY_NAMES if path else LIBRARY_NAMES
+    for name in names:
+        try:
+            lib = ctypes.CDLL(name)
+            break
+        except OSError:
+            continue
+    else:
+        raise OSError("libtesseract not found")
+
+    p, s, i = ctypes.c_void_p, ctypes.c_char_p, ctypes.c_int
+    for func, argtypes, restype in (
+        ("TessBaseAPICreate", [], p),
+        ("TessBaseAPIInit3", [p, s, s], i),
+        ("TessBaseAPISetVariable", [p, s, s], i),
+        ("TessBaseAPIGetDatapath", [p], s),
+        ("TessBaseAPIProcessPages", [p, s, s, i, p], i),
+        ("TessBaseAPIEnd", [p], None),
+        ("TessBaseAPIDelete", [p], None),
+        ("TessPDFRendererCreate", [s, s, i], p),
+        ("TessHOcrRendererCreate", [s], p),
+        ("TessTextRendererCreate", [s], p),
+        ("TessResultRendererInsert", [p, p], None),
+        ("TessDeleteResultRenderer", [p], None),
+    ):
+        getattr(lib, func).argtypes = argtypes
+        getattr(lib, func).restype = restype
+    return lib
+
+
+def output_files(output_base, formats):
+    return {fmt: f"{output_base}.{fmt}" for fmt in formats}
+
+
+class TesseractEngine:
+    """A libtesseract instance with the model for `lang` loaded."""
+
+    def __init__(self, lang, lib=None):
+        self.lang = lang
+        self.lib = lib or load_library()
+        self.handle = self.lib.TessBaseAPICreate()
+        if self.lib.TessBaseAPIInit3(self.handle, None, lang.encode()):
+            self.lib.TessBaseAPIDelete(self.handle)
+            raise OcrError(f"Can't initialize tesseract for {lang}")
+        # the pdf renderer needs the tessdata dir for its glyphless font
+        self.datapath = self.lib.TessBaseAPIGetDatapath(self.handle)
+
+    def recognize(
+        self, image, output_base, formats, config=None, textonly=False
+    ):
+        """
+        OCR `image` and write `output_base`.FORMAT for each of
+        `formats`. `config` is a dict of tesseract variables, and
+        `textonly` leaves the image out of the pdf.
+
+        Returns a dict mapping each format to its output file.
+        """
+        lib = self.lib
+        for name, value in (config or {}).items():
+            if not lib.TessBaseAPISetVariable(
+                self.handle, name.encode(), str(value).encode()
+            ):
+                raise OcrError(f"Unknown tesseract variable {name}")
+
+        base = os.fsencode(output_base)
+        renderer = None
+        try:
+            for fmt in formats:
+                if fmt == "pdf":
+                    r = lib.TessPDFRendererCreate(
+                        base, self.datapath, int(textonly)
+                    )
+                elif fmt == "hocr":
+                    r = lib.TessHOcrRendererCreate(base)
+                elif fmt == "txt":
+                    r = lib.TessTextRendererCreate(base)
+                else:
+                    raise ValueError(f"Unsupported format {fmt}")
+                if renderer is None:
+                    renderer = r
+                else:
+                    lib.TessResultRendererInsert(renderer, r)
+            ok = lib.TessBaseAPIProcessPages(
+                self.handle, os.fsencode(image), None, 0, renderer
+            )
+        finally:
+            # also deletes the renderers inserted after it
+            if renderer:
+                lib.TessDeleteResultRenderer(renderer)
+        if not ok:
+            raise OcrError(f"tesseract failed on {image}")
+        return output_files(output_base, formats)
+
+    def close(self):
+        self.lib.TessBaseAPIEnd(self.handle)
+        self.lib.TessBaseAPIDelete(self.handle)
+
+
+class TesseractCli:
+    """Fallback running the tesseract command once per page."""
+
+    def __init__(self, lang):
+        self.lang = lang
+
+    def recognize(
+        self, image, output_base, formats, config=None, textonly=False
+    ):
+        cmd = ["tesseract", image, output_base, "-l", self.lang]
+        config = dict(config or {})
+        if textonly:
+            config["textonly_pdf"] = 1
+        for name, value in config.items():
+            cmd += ["-c", f"{name}={value}"]
+        cmd += formats
+        logging.debug("Running cmd: %s", cmd)
+        try:
+            subprocess.run(cmd, check=True, capture_output=True, text=True)
+        except subprocess.CalledProcessError as e:
+            raise OcrError(f"tesseract failed on {image}: {e.stderr}")
+        return output_files(output_base, formats)
+
+    def close(self):
+        pass
+
+
+def get_engine(lang="eng", cli=False):
+    """
+    Return this process's engine for `lang`, creating it on first use.
+    Falls back to the tesseract command if libtesseract isn't available
+    or if `cli` is set.
+    """
+    key = (lang, cli)
+    if key not in _engines:
+        engine = None
+        if not cli:
+            try:
+                engine = TesseractEngine(lang)
+            except (OSError, AttributeError) as e:
+                logging.warning(
+                    "Can't use libtesseract, running tesseract: %s", e
+                )
+        _engines[key] = engine or TesseractCli(lang)
+    return _engines[key]
+
+
+def recognize(image, output_base, lang="eng", cli=False, **kwargs):
+    """OCR one image with this process's engine for `lang`."""
+    engine = get_engine(lang, cli)
+    return engine.recognize(image, output_base, **kwargs)
+
+
+def positive_int(value):
+    try:
+        i = int(value)
+    except ValueError:
+        raise argparse.ArgumentTypeError(f"{value!r} is not a valid integer")
+    if i <= 0:
+        raise argparse.ArgumentTypeError("value must be a positive integer")
+    return i
+
+
+def parse_formats(value):
+    formats = value.split(",")
+    for fmt in formats:
+        if fmt not in FORMATS:
+            raise argparse.ArgumentTypeError(f"unsupported format {fmt!r}")
+    return formats
+
+
+def read_list(list_file):
+    """Read tab separated image and output base pairs."""
+    pairs = []
+    with open(list_file) if list_file != "-" else sys.stdin as f:
+        for line in f:
+            line = line.rstrip("\n")
+            if line:
+                image, output_base = line.split("\t")
+                pairs.append((image, output_base))
+    return pairs
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="OCR images with tesseract, loading each model once"
+    )
+    parser.add_argument("images", nargs="*", metavar="IMAGE")
+    parser.add_argument(
+        "-l", "--lang", default="eng", help="Tesseract language(s)"
+    )
+    parser.add_argument(
+        "-f",
+        "--format",
+        type=parse_formats,
+        default=["hocr"],
+        help="Comma separated output formats: pdf, hocr, txt (default: hocr)",
+    )
+    parser.add_argument(
+        "--textonly", action="store_true", help="Leave images out of pdf"
+    )
+    parser.add_argument(
+        "-o", "--outdir", default=".", help="Output directory for IMAGEs"
+    )
+    parser.add_argument(
+        "--list",
+        metavar="FILE",
+        help="Read IMAGE<TAB>OUTPUT_BASE lines from FILE ('-' for stdin)",
+    )
+    parser.add_argument(
+        "-c",
+        "--config",
+        action="append",
+        default=[],
+        metavar="VAR=VALUE",
+        help="Set a tesseract variable",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=positive_int,
+        default=1,
+        help="Number of images to OCR in parallel (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--cli", action="store_true", help="Always run the tesseract command"
+    )
+    parser.add_argument(
+        "-d", "--debug", help="Enable debugging messages", action="store_true"
+    )
+    args = parser.parse_args()
+
+    level = logging.DEBUG if args.debug else logging.WARNING
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=level)
+
+    pairs = []
+    for image in args.images:
+        name = os.path.splitext(os.path.basename(image))[0]
+        pairs.append((image, os.path.join(args.outdir, name)))
+    if args.list:
+        pairs += read_list(args.list)
+    if not pairs:
+        parser.error("no images given")
+
+    config = dict(item.split("=", 1) for item in args.config)
+    if not args.debug:
+        config.setdefault("debug_file", os.devnull)
+
+    # Each worker has its own engine, so keep it single threaded to
+    # avoid oversubscribing the cpus.
+    if args.jobs > 1:
+        os.environ["OMP_THREAD_LIMIT"] = "1"
+
+    kwargs = {
+        "lang": args.lang,
+        "cli": args.cli,
+        "formats": args.format,
+        "config": config,
+        "textonly": args.textonly,
+    }
+    exit_code = 0
+    with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+        futures = [
+            (image, executor.submit(recognize, image, base, **kwargs))
+            for image, base in pairs
+        ]
+        for image, future in futures:
+            try:
+                future.result()
+                logging.debug("OCRed %s", image)
+            except OcrError as e:
+                print(e, file=sys.stderr)
+                exit_code = 1
+
+    sys.exit(exit_code)
+
+
+if __name__ == "__main__":
+    main()
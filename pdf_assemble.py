@@ -0,0 +1,193 @@
+#!/usr/bin/python3
+#
+# Assemble a PDF from the pages of other PDFs in a single write.
+#
+# Pages are appended to one output document, optionally with the
+# matching page of an overlay PDF (e.g. a tesseract text-only layer)
+# stamped on top.  The document info dictionary and XMP metadata are
+# dropped and the file is linearized as it is saved, so a book is
+# written once instead of once per pdftk, exiftool and qpdf pass.
+# jpeg_page() makes a page from a JPEG file without recompressing it.
+# The module is used as a library by the python scripts and as a
+# command line tool by the perl scripts, e.g.
+#
+#   pdf_assemble.py -o book.pdf page1.pdf page2.pdf ...
+
+import argparse
+import io
+import logging
+import os
+import pikepdf
+import PIL.Image
+import sys
+import tempfile
+
+# pdf color spaces of the Pillow modes jpeg_page can embed
+COLOR_SPACES = {"L": pikepdf.Name.DeviceGray, "RGB": pikepdf.Name.DeviceRGB}
+
+
+class PdfAssembler:
+    """
+    Build one PDF from the pages of others.
+
+    Source documents are read into memory, not kept open, so books with
+    thousands of single page inputs don't run out of file descriptors.
+    Their pages are only copied into the output when it is saved.
+    """
+
+    def __init__(self):
+        self.pdf = pikepdf.new()
+        self.sources = []
+
+    def open(self, pdf_file):
+        with open(pdf_file, "rb") as f:
+            src = pikepdf.open(io.BytesIO(f.read()))
+        self.sources.append(src)
+        return src
+
+    def append(self, pdf_file, overlay=None):
+        """
+        Append all pages of `pdf_file`. If `overlay` is given, each of
+        its pages is drawn over the matching page of `pdf_file`, like
+        ``pdftk OVERLAY background PDF_FILE``.
+        """
+        src = self.open(pdf_file)
+        over = self.open(overlay) if overlay else None
+        if over and len(over.pages) != len(src.pages):
+            raise ValueError(
+                f"{overlay} has {len(over.pages)} pages, "
+                f"{pdf_file} has {len(src.pages)}"
+            )
+        for i, page in enumerate(src.pages):
+            self.pdf.pages.append(page)
+            if over:
+                self.pdf.pages[-1].add_overlay(over.pages[i])
+
+    def strip_metadata(self):
+        """Remove document and page metadata, like exiftool -all:all=."""
+        if "/Info" in self.pdf.trailer:
+            del self.pdf.trailer.Info
+        if "/Metadata" in self.pdf.Root:
+            del self.pdf.Root.Metadata
+        for page in self.pdf.pages:
+            for key in ("/Metadata", "/PieceInfo"):
+                if key in page.obj:
+                    del page.obj[key]
+
+    def save(self, output_file, linearize=True, keep_metadata=False):
+        """Write the document to a temp file and move it into place."""
+        if not keep_metadata:
+            self.strip_metadata()
+        outdir = os.path.dirname(os.path.abspath(output_file))
+        fd, tmp_file = tempfile.mkstemp(dir=outdir, suffix=".pdf")
+        os.close(fd)
+        try:
+            self.pdf.save(tmp_file, linearize=linearize)
+            os.replace(tmp_file, output_file)
+        except BaseException:
+            os.remove(tmp_file)
+            raise
+        finally:
+            self.close()
+        logging.debug("Wrote %s, %d pages", output_file, len(self.pdf.pages))
+
+    def close(self):
+        for src in self.sources:
+            src.close()
+        self.sources = []
+
+
+def jpeg_page(jpeg_file, output_file, dpi):
+    """
+    Write a single page PDF showing `jpeg_file` at `dpi`. The JPEG data
+    is embedded as is, without being decoded or recompressed, so the
+    image must be grayscale or RGB.
+    """
+    with PIL.Image.open(jpeg_file) as img:
+        if img.format != "JPEG" or img.mode not in COLOR_SPACES:
+            raise ValueError(f"Can't embed {img.mode} {img.format} as JPEG")
+        width, height = img.size
+        color_space = COLOR_SPACES[img.mode]
+    with open(jpeg_file, "rb") as f:
+        data = f.read()
+
+    pdf = pikepdf.new()
+    image = pikepdf.Stream(
+        pdf,
+        data,
+        Type=pikepdf.Name.XObject,
+        Subtype=pikepdf.Name.Image,
+        Width=width,
+        Height=height,
+        ColorSpace=color_space,
+        BitsPerComponent=8,
+        Filter=pikepdf.Name.DCTDecode,
+    )
+    page_width, page_height = width * 72 / dpi, height * 72 / dpi
+    pdf.add_blank_page(page_size=(page_width, page_height))
+    page = pdf.pages[0]
+    page.Resources = pikepdf.Dictionary(XObject=pikepdf.Dictionary(Im0=image))
+    page.Contents = pdf.make_stream(
+        f"q {page_width:.4f} 0 0 {page_height:.4f} 0 0 cm /Im0 Do Q".encode()
+    )
+    pdf.save(output_file)
+
+
+def assemble(pdf_files, output_file, overlays=None, **kwargs):
+    """
+    Write the pages of `pdf_files`, in order, to `output_file` in one
+    pass. `overlays`, if given, is a list of PDFs drawn over the
+    corresponding files in `pdf_files`. Keyword arguments are passed to
+    PdfAssembler.save.
+    """
+    assembler = PdfAssembler()
+    try:
+        for i, pdf_file in enumerate(pdf_files):
+            assembler.append(pdf_file, overlays[i] if overlays else None)
+    except BaseException:
+        assembler.close()
+        raise
+    assembler.save(output_file, **kwargs)
+
+
+def main():
+    parser = argparse.ArgumentParser(
+        description="Concatenate PDFs, strip metadata and linearize"
+    )
+    parser.add_argument("pdf_files", nargs="+", metavar="PDF_FILE")
+    parser.add_argument(
+        "-o", "--output", required=True, help="output pdf file"
+    )
+    parser.add_argument(
+        "--no-linearize",
+        dest="linearize",
+        action="store_false",
+        help="Don't linearize the output",
+    )
+    parser.add_argument(
+        "--keep-metadata",
+        action="store_true",
+        help="Don't remove document info and XMP metadata",
+    )
+    parser.add_argument(
+        "-d", "--debug", help="Enable debugging messages", action="store_true"
+    )
+    args = parser.parse_args()
+
+    level = logging.DEBUG if args.debug else logging.WARNING
+    logging.basicConfig(format="%(levelname)s: %(message)s", level=level)
+
+    try:
+        assemble(
+            args.pdf_files,
+            args.output,
+            linearize=args.linearize,
+            keep_metadata=args.keep_metadata,
+        )
+    except (OSError, ValueError, pikepdf.PdfError) as e:
+        print(f"Can't assemble {args.output}: {e}", file=sys.stderr)
+        sys.exit(1)
+
+
+if __name__ == "__main__":
+    main()
@@ -5,15 +5,26 @@
 # Requires the following tools:
 # ImageMagick, poppler, pdf2djvu, ocrodjvu, and hocr-tools
 #
+# The hOCR of pages with a text layer is read directly from the pdf
+# with pdftotext; pdf2djvu and djvu2hocr are only run for the pages
+# without one, or for every page with --djvu-hocr.
+#
 # rasan@nyu.edu
 
-from pprint import pformat
+from concurrent.futures import FIRST_EXCEPTION, ProcessPoolExecutor, wait
+from lxml import etree
 import argparse
 import functools
 import glob
+import hashlib
+import html
+import image_probe
+import jpeg_resample
 import logging
 import math
 import os
+import pdf_assemble
+import pikepdf
 import PIL.Image
 import re
 import shutil
@@ -25,6 +36,26 @@ import time
 
 print = functools.partial(print, flush=True)
 
+# ImageMagick's default quality when the input isn't a JPEG
+JPEG_QUALITY = 92
+
+# tools used to extract hocr from page pdfs
+HOCR_TOOLS = ["pdf2djvu", "djvu2hocr"]
+
+XHTML_NS = "{http://www.w3.org/1999/xhtml}"
+
+HOCR_HEADER = """<?xml version="1.0" encoding="UTF-8"?>
+<!DOCTYPE html PUBLIC "-//W3C//DTD XHTML 1.0 Transitional//EN"
+ "http://www.w3.org/TR/xhtml1/DTD/xhtml1-transitional.dtd">
+<html xmlns="http://www.w3.org/1999/xhtml" xml:lang="en" lang="en">
+<head>
+<meta http-equiv="Content-Type" content="text/html; charset=utf-8" />
+<meta name="ocr-system" content="pdftotext" />
+<meta name="ocr-capabilities" content="ocr_page ocr_line ocrx_word" />
+</head>
+<body>
+"""
+
 
 def do_cmd(cmdlist, **kwargs):
     cmd = list(map(str, cmdlist))
@@ -33,7 +64,7 @@ def do_cmd(cmdlist, **kwargs):
         process = subprocess.run(cmd, check=True, **kwargs)
     except Exception as e:
         logging.exception(e)
-        sys.exit(1)
+        raise
     return process
 
 
@@ -41,32 +72,238 @@ def round_down_to_even(num):
     return math.floor(float(num) / 2.0) * 2
 
 
-def get_img_info(pdf_file):
-    ret = do_cmd(
-        ["pdfimages", "-l", 1, "-list", pdf_file],
-        stdout=subprocess.PIPE,
-        universal_newlines=True,
+# pdfimages names of the image encodings, by pdf filter
+IMAGE_CODECS = {
+    "/DCTDecode": "jpeg",
+    "/JPXDecode": "jpx",
+    "/JBIG2Decode": "jbig2",
+    "/CCITTFaxDecode": "ccitt",
+}
+
+IDENTITY = (1, 0, 0, 1, 0, 0)
+
+
+def multiply(m, n):
+    """Return the product of two pdf transformation matrices."""
+    a, b, c, d, e, f = m
+    return (
+        a * n[0] + b * n[2],
+        a * n[1] + b * n[3],
+        c * n[0] + d * n[2],
+        c * n[1] + d * n[3],
+        e * n[0] + f * n[2] + n[4],
+        e * n[1] + f * n[3] + n[5],
     )
-    output = ret.stdout.splitlines()
-    logging.debug("pdfimages output: %s", output)
-    if len(output) < 3:
-        return None
 
-    col_idx = {header: i for i, col in enumerate(output[0].split())}
-    logging.debug("column index: %s", pformat(col_idx))
 
-    imgdata = output[2].split()
+def get_resources(page):
+    """Return the resources of `page`, which may be inherited."""
+    node = page
+    while node is not None:
+        if "/Resources" in node:
+            return node.Resources
+        node = node.get("/Parent")
+    return pikepdf.Dictionary()
+
+
+def describe_image(xobj, ctm):
+    """Return the properties of an image XObject drawn with `ctm`."""
+    filters = xobj.get("/Filter")
+    if isinstance(filters, pikepdf.Array):
+        filters = filters[-1] if len(filters) else None
+    width, height = int(xobj.Width), int(xobj.Height)
+    # the image fills the unit square, so the ctm gives its size
+    # in points
+    x_pts = math.hypot(ctm[0], ctm[1])
+    y_pts = math.hypot(ctm[2], ctm[3])
+    mask = xobj.get("/Mask")
+    pixels = width * height
+    if isinstance(mask, pikepdf.Stream):
+        pixels += int(mask.Width) * int(mask.Height)
+    return {
+        "codec": IMAGE_CODECS.get(str(filters), "image"),
+        "width": width,
+        "height": height,
+        "x_ppi": width * 72 / x_pts if x_pts else 0,
+        "y_ppi": height * 72 / y_pts if y_pts else 0,
+        "stencil": bool(xobj.get("/ImageMask", False)),
+        "mask": isinstance(mask, pikepdf.Stream),
+        "smask": "/SMask" in xobj,
+        "pixels": pixels,
+    }
+
+
+def find_images(content, resources, ctm=IDENTITY, depth=0):
+    """Yield the images drawn by `content`, following form XObjects."""
+    xobjects = resources.get("/XObject", {})
+    stack = []
+    for operands, operator in pikepdf.parse_content_stream(
+        content, "q Q cm Do"
+    ):
+        op = str(operator)
+        if op == "q":
+            stack.append(ctm)
+        elif op == "Q" and stack:
+            ctm = stack.pop()
+        elif op == "cm":
+            ctm = multiply([float(x) for x in operands], ctm)
+        elif op == "Do":
+            xobj = xobjects.get(str(operands[0]))
+            if not isinstance(xobj, pikepdf.Stream):
+                continue
+            subtype = xobj.get("/Subtype")
+            if subtype == "/Image":
+                yield describe_image(xobj, ctm)
+            elif subtype == "/Form" and depth < 8:
+                matrix = [float(x) for x in xobj.get("/Matrix", IDENTITY)]
+                yield from find_images(
+                    xobj,
+                    xobj.get("/Resources", resources),
+                    multiply(matrix, ctm),
+                    depth + 1,
+                )
+
+
+def plan_page(images):
+    """
+    Decide how to shrink a page from its images: the extension of the
+    first image (jpg or jp2 can be extracted as is, None for anything
+    else), its resolution, whether the page has a mask to composite and
+    the expected cost of the page in source pixels.
+    """
+    if not images:
+        return None
     ext = {"jpeg": "jpg", "jpx": "jp2"}
-    codec = imgdata[col_idx["enc"]]
-    dpi = round_down_to_even(imgdata[col_idx["x-ppi"]])
-    mask = False
-    for line in output[2:]:
-        logging.debug(line)
-        imgdata = line.split()
-        if imgdata[col_idx["type"]] == "mask":
-            mask = True
-            break
-    return {"ext": ext.get(codec), "dpi": dpi, "mask": mask}
+    first = images[0]
+    return {
+        "ext": ext.get(first["codec"]),
+        "dpi": round_down_to_even(first["x_ppi"]),
+        # an explicit /Mask, pdfimages' mask type. Stencil images are
+        # single images with nothing to composite.
+        "mask": any(img["mask"] for img in images),
+        "cost": sum(img["pixels"] for img in images),
+    }
+
+
+def image_inventory(pdf_file, last_page=None):
+    """
+    Walk the pages of `pdf_file` once and return a list with the images
+    drawn on each page, in the order pdfimages lists them.
+    """
+    inventory = []
+    with pikepdf.open(pdf_file) as pdf:
+        for page in pdf.pages[:last_page]:
+            images = list(find_images(page, get_resources(page.obj)))
+            inventory.append(images)
+    return inventory
+
+
+def plan_pages(pdf_file, last_page=None):
+    """Return the plan_page of every page of `pdf_file`."""
+    plans = []
+    missing = []
+    for i, images in enumerate(image_inventory(pdf_file, last_page)):
+        logging.debug("page %d images: %s", i + 1, images)
+        plans.append(plan_page(images))
+        if not images:
+            missing.append(str(i + 1))
+    if missing:
+        raise RuntimeError(
+            f"Can't find any images on page(s) {', '.join(missing)}"
+        )
+    return plans
+
+
+def get_bbox(elem):
+    return tuple(
+        float(elem.get(attr)) for attr in ("xMin", "yMin", "xMax", "yMax")
+    )
+
+
+def extract_text_layer(pdf_file, last_page=None):
+    """Read the position of every word of `pdf_file` in a single pass.
+
+    Runs ``pdftotext -bbox-layout``, which reads the text runs of each
+    page's content stream, and returns a dict mapping the index of each
+    page that has text to a dict with its width, height and a list of
+    (line bbox, [(word bbox, word), ...]) tuples. Coordinates are in
+    points from the top left corner of the page.
+    """
+    cmd = ["pdftotext", "-bbox-layout"]
+    if last_page:
+        cmd += ["-l", str(last_page)]
+    cmd += [pdf_file, "-"]
+    logging.debug("Running command: %s", " ".join(cmd))
+    text_layer = {}
+    with subprocess.Popen(cmd, stdout=subprocess.PIPE) as process:
+        events = etree.iterparse(process.stdout, tag=XHTML_NS + "page")
+        for i, (_, page) in enumerate(events):
+            lines = []
+            for line in page.iter(XHTML_NS + "line"):
+                words = [
+                    (get_bbox(word), word.text)
+                    for word in line.iter(XHTML_NS + "word")
+                    if word.text and word.text.strip()
+                ]
+                if words:
+                    lines.append((get_bbox(line), words))
+            if lines:
+                text_layer[i] = {
+                    "width": float(page.get("width")),
+                    "height": float(page.get("height")),
+                    "lines": lines,
+                }
+            page.clear()
+    if process.returncode:
+        raise subprocess.CalledProcessError(process.returncode, cmd)
+    logging.debug(
+        "Found a text layer on %d pages of %s", len(text_layer), pdf_file
+    )
+    return text_layer
+
+
+def write_hocr(page, hocr_file, scale):
+    """Write the text of a page from extract_text_layer as hOCR.
+
+    Point coordinates are multiplied by `scale` to get the image
+    coordinates hocr-pdf expects.
+    """
+
+    def bbox(coords):
+        return "bbox " + " ".join(str(round(c * scale)) for c in coords)
+
+    page_bbox = (0, 0, page["width"], page["height"])
+    with open(hocr_file, "w", encoding="utf-8") as f:
+        f.write(HOCR_HEADER)
+        f.write(f"<div class='ocr_page' title='{bbox(page_bbox)}'>\n")
+        for line_bbox, words in page["lines"]:
+            f.write(f"<span class='ocr_line' title='{bbox(line_bbox)}'>")
+            f.write(
+                " ".join(
+                    f"<span class='ocrx_word' title='{bbox(word_bbox)}'>"
+                    f"{html.escape(text)}</span>"
+                    for word_bbox, text in words
+                )
+            )
+            f.write("</span>\n")
+        f.write("</div>\n</body>\n</html>\n")
+
+
+def write_text_hocr(pages, text_layer, scale_hocr, args, aux_dir=None):
+    """Write hOCR next to each page of (index, pdf_file, plan) `pages`
+    that has a text layer, and copy it to `aux_dir` if given."""
+    # hocr-pdf converts hocr coordinates to points as
+    # coord * 72 / dpi * scale_hocr
+    scale = args.dpi / 72 / scale_hocr
+    for i, pdf_file, _ in pages:
+        if i not in text_layer:
+            continue
+        hocr_file = os.path.splitext(pdf_file)[0] + ".hocr"
+        write_hocr(text_layer[i], hocr_file, scale)
+        if aux_dir:
+            dest_file = aux_dir + "/" + os.path.basename(hocr_file)
+            if not os.path.isfile(dest_file):
+                shutil.copyfile(hocr_file, dest_file)
 
 
 def mv(src, dst):
@@ -74,15 +311,493 @@ def mv(src, dst):
     shutil.move(src, dst)
 
 
+def du(path):
+    """Return total size in bytes of the files under `path`."""
+    if os.path.isfile(path):
+        return os.path.getsize(path)
+    total = 0
+    for root, _, names in os.walk(path):
+        for name in names:
+            total += os.path.getsize(os.path.join(root, name))
+    return total
+
+
+def format_size(num_bytes):
+    return f"{num_bytes / 2**20:.1f} MiB"
+
+
+def split_pages(pdf_file, outdir, first, last, width):
+    """Split pages `first` to `last` of `pdf_file` into `outdir`.
+
+    Files are named by their page number in the input zero padded to
+    `width` digits, the same as ``qpdf --split-pages`` names them when
+    splitting the whole document.
+    """
+    chunk_dir = tempfile.mkdtemp(dir=outdir)
+    do_cmd([
+        "qpdf",
+        "--empty",
+        "--pages",
+        pdf_file,
+        f"{first}-{last}",
+        "--",
+        "--split-pages",
+        "--deterministic-id",
+        f"{chunk_dir}/%d.pdf",
+    ])
+    page_files = []
+    chunk_files = sorted(glob.glob(f"{chunk_dir}/*.pdf"))
+    for page_num, chunk_file in enumerate(chunk_files, start=first):
+        page_file = os.path.join(outdir, f"{page_num:0{width}d}.pdf")
+        mv(chunk_file, page_file)
+        page_files.append(page_file)
+    os.rmdir(chunk_dir)
+    return page_files
+
+
+def get_tool_version(prog):
+    """Return the first line printed by ``prog --version``."""
+    ret = subprocess.run(
+        [prog, "--version"],
+        stdout=subprocess.PIPE,
+        stderr=subprocess.STDOUT,
+        universal_newlines=True,
+    )
+    lines = ret.stdout.strip().splitlines()
+    return lines[0] if lines else ""
+
+
+def hash_object(obj, digest, seen):
+    """Add a pdf object and the objects it refers to to `digest`.
+
+    `seen` maps indirect objects already hashed to the order they were
+    hashed in, which is used for later references to them. Dictionary
+    keys are hashed in sorted order and /Parent links are skipped, so
+    the result doesn't depend on where the object sits in its file.
+    """
+    if isinstance(obj, pikepdf.Object) and obj.is_indirect:
+        if obj.objgen in seen:
+            digest.update(f"R{seen[obj.objgen]};".encode())
+            return
+        seen[obj.objgen] = len(seen)
+
+    if isinstance(obj, (pikepdf.Dictionary, pikepdf.Stream)):
+        digest.update(b"<<")
+        for key in sorted(obj.keys()):
+            if key != "/Parent":
+                digest.update(key.encode() + b" ")
+                hash_object(obj[key], digest, seen)
+        digest.update(b">>")
+        if isinstance(obj, pikepdf.Stream):
+            data = obj.read_raw_bytes()
+            digest.update(f"stream{len(data)};".encode() + data)
+    elif isinstance(obj, pikepdf.Array):
+        digest.update(b"[")
+        for item in obj:
+            hash_object(item, digest, seen)
+        digest.update(b"]")
+    elif isinstance(obj, pikepdf.Object):
+        digest.update(obj.unparse() + b";")
+    else:
+        # numbers and booleans are returned as python objects
+        digest.update(repr(obj).encode() + b";")
+
+
+class HocrCache:
+    """
+    Content addressed cache of hOCR files extracted from page pdfs.
+
+    Entries are keyed by a hash of the page's content and the versions
+    of the tools used to extract the text, and stored as
+    ``<cache_dir>/<key[:2]>/<key>.hocr``. Reading an entry updates its
+    modification time so evict() removes the least recently used
+    entries first.
+    """
+
+    def __init__(self, cache_dir, max_bytes, versions):
+        self.cache_dir = cache_dir
+        self.max_bytes = max_bytes
+        self.versions = versions
+
+    def key(self, pdf_file):
+        """
+        Hash the page of a single page pdf. Only the page dictionary
+        and the objects it refers to are hashed, not the file, whose
+        /ID and object numbers change every time a page is split.
+        """
+        digest = hashlib.sha256()
+        for version in self.versions:
+            digest.update(version.encode() + b"\0")
+        with pikepdf.open(pdf_file) as pdf:
+            hash_object(pdf.pages[0].obj, digest, {})
+        return digest.hexdigest()
+
+    def path(self, key):
+        return os.path.join(self.cache_dir, key[:2], key + ".hocr")
+
+    def get(self, key, hocr_file):
+        """Copy the cached entry to `hocr_file`, returning True if found."""
+        cache_file = self.path(key)
+        try:
+            shutil.copyfile(cache_file, hocr_file)
+            os.utime(cache_file)
+        except FileNotFoundError:
+            return False
+        return True
+
+    def put(self, key, hocr_file):
+        cache_file = self.path(key)
+        os.makedirs(os.path.dirname(cache_file), exist_ok=True)
+        # write to a temp file first so other processes never
+        # see a partially copied entry
+        fd, tmp_file = tempfile.mkstemp(dir=os.path.dirname(cache_file))
+        os.close(fd)
+        shutil.copyfile(hocr_file, tmp_file)
+        os.replace(tmp_file, cache_file)
+
+    def evict(self):
+        """Remove least recently used entries until under max_bytes."""
+        entries = []
+        total = 0
+        for root, _, names in os.walk(self.cache_dir):
+            for name in names:
+                path = os.path.join(root, name)
+                stat = os.stat(path)
+                entries.append((stat.st_mtime, stat.st_size, path))
+                total += stat.st_size
+
+        for _, size, path in sorted(entries):
+            if total <= self.max_bytes:
+                break
+            logging.debug("Evicting %s from hocr cache", path)
+            os.remove(path)
+            total -= size
+
+
+def get_scale_hocr(imginfo, dpi):
+    scale_hocr = dpi / imginfo["dpi"]
+    if imginfo["mask"]:
+        scale_hocr *= (4 / 3) * (1 / 2)
+    logging.debug("Setting scale for hocr to %s", scale_hocr)
+    return scale_hocr
+
+
+def composite_masked_page(
+    bot_file, masked_file, mask_file, src_dpi, dpi, output_file
+):
+    """Merge the images of a masked page and resample them to `dpi`.
+
+    Masked pages contain a bottom layer, a top/text layer and a mask
+    for the top layer. The mask is applied to the top layer as its
+    opacity, the result is placed over the bottom layer and the merged
+    image is resampled from `src_dpi` to `dpi`. Everything is done in
+    memory and only the final JPEG is written.
+    """
+    with PIL.Image.open(bot_file) as bot, PIL.Image.open(masked_file) as top:
+        gray = {"1", "L"}
+        mode = "L" if {bot.mode, top.mode} <= gray else "RGB"
+        merged = bot.convert(mode)
+        top = top.convert(mode)
+    with PIL.Image.open(mask_file) as mask:
+        # mask image is twice as large as other images so we
+        # must resize it to match them before applying it
+        alpha = mask.convert("L").resize(top.size, PIL.Image.LANCZOS)
+    merged.paste(top, (0, 0), alpha)
+
+    size = (
+        max(1, round(merged.width * dpi / src_dpi)),
+        max(1, round(merged.height * dpi / src_dpi)),
+    )
+    merged = merged.resize(size, PIL.Image.LANCZOS)
+    merged.save(output_file, quality=JPEG_QUALITY, dpi=(dpi, dpi))
+
+
+def shrink_page(
+    pdf_file,
+    i,
+    imginfo,
+    args,
+    hocr_files,
+    aux_dir,
+    hocr_cache=None,
+    cleanup=False,
+    text_pages=frozenset(),
+):
+    """Create a reduced jpg and hocr file for a single page pdf.
+
+    `imginfo` is the plan_page of the page. The jpg and hocr files are
+    written next to `pdf_file` with the same basename. The hocr of pages
+    in `text_pages` is read from the text layer of the pdf instead, see
+    write_text_hocr. If `cleanup` is set, the images extracted from the
+    page, the djvu file and `pdf_file` itself are removed once they are
+    no longer needed.
+
+    Returns a tuple of the number of bytes used by intermediate files
+    before they were removed and whether the extracted jpg was used
+    as is.
+    """
+    logging.debug("imginfo: %s", imginfo)
+    if imginfo["ext"] is None or imginfo["mask"]:
+        img_ext = "png"
+        pdfimgs_arg = "-png"
+    else:
+        img_ext = imginfo["ext"]
+        pdfimgs_arg = "-all"
+
+    # set up file paths
+    tmpdir = os.path.dirname(pdf_file)
+    basename = os.path.splitext(pdf_file)[0]
+    pdfimgs_dir = os.path.join(tmpdir, "pdfimgs_%03d" % (i + 1))
+    pdfimgs_base = os.path.join(pdfimgs_dir, os.path.basename(basename))
+    djvu_file = basename + ".djvu"
+    hocr_file = basename + ".hocr"
+    new_jpg_file = basename + ".jpg"
+    old_img_file = pdfimgs_base + "-000." + img_ext
+
+    logging.debug("Creating directory %s", pdfimgs_dir)
+    os.mkdir(pdfimgs_dir)
+
+    # extract jpg image from pdf page
+    do_cmd(["pdfimages", pdfimgs_arg, pdf_file, pdfimgs_base])
+
+    # hocr-pdf embeds jpeg files without recompressing them, so a
+    # jpeg with the target resolution only needs its density set
+    passthrough = (
+        img_ext == "jpg"
+        and imginfo["dpi"] == args.dpi
+        and image_probe.set_jpeg_density(old_img_file, args.dpi)
+    )
+
+    if imginfo["mask"]:
+        # merge the layers and shrink the result in a single pass
+        composite_masked_page(
+            old_img_file,
+            pdfimgs_base + "-001." + img_ext,
+            pdfimgs_base + "-002." + img_ext,
+            imginfo["dpi"],
+            args.dpi,
+            new_jpg_file,
+        )
+    elif passthrough:
+        # already at the target resolution, so use the extracted
+        # jpeg as is
+        logging.debug("Using %s as is", old_img_file)
+        mv(old_img_file, new_jpg_file)
+    else:
+        # shrink image size by reducing quality
+        method = jpeg_resample.resample(
+            old_img_file, imginfo["dpi"], args.dpi, new_jpg_file, args.resample
+        )
+        logging.debug("Resampled %s for %s", new_jpg_file, method)
+
+    # Check that shrunken image has correct resolution
+    with PIL.Image.open(new_jpg_file) as new_jpg:
+        new_jpg_dpi = new_jpg.info["dpi"][0]
+    logging.debug("dpi %s: %s", new_jpg_file, new_jpg_dpi)
+    if new_jpg_dpi != args.dpi:
+        raise RuntimeError(
+            f"Expected dpi {args.dpi} for {new_jpg_file}, "
+            f"found {new_jpg_dpi} instead"
+        )
+
+    if args.use_existing_hocr:
+        # hocr files seem to shifted by 1
+        if i == len(hocr_files) - 1:
+            j = 0
+        else:
+            j = i + 1
+        logging.debug("Copying %s to %s", hocr_files[j], hocr_file)
+        shutil.copyfile(hocr_files[j], hocr_file)
+    elif i in text_pages:
+        logging.debug("Using text layer of %s for hocr", pdf_file)
+    else:
+        cache_key = hocr_cache.key(pdf_file) if hocr_cache else None
+        if cache_key and hocr_cache.get(cache_key, hocr_file):
+            logging.debug("Using cached hocr for %s", pdf_file)
+        else:
+            # convert pdf page to djvu file
+            do_cmd(["pdf2djvu", "-q", "-o", djvu_file, pdf_file])
+
+            # extract hidden text from djvu file as hocr
+            with open(hocr_file, "w") as f:
+                ret = do_cmd(
+                    ["djvu2hocr", djvu_file],
+                    stdout=f,
+                    stderr=subprocess.PIPE,
+                )
+                logging.debug(ret.stderr.decode().strip())
+
+            if cache_key:
+                hocr_cache.put(cache_key, hocr_file)
+
+    # generating hocr is time consuming so we copy file
+    # to aux directory for later use
+    if aux_dir and i not in text_pages:
+        dest_file = aux_dir + "/" + os.path.basename(hocr_file)
+        if not os.path.isfile(dest_file):
+            shutil.copyfile(hocr_file, dest_file)
+
+    tmp_bytes = 0
+    if cleanup:
+        tmp_bytes = du(pdfimgs_dir)
+        # delete images extracted from pdfimages
+        logging.debug("Removing directory %s", pdfimgs_dir)
+        shutil.rmtree(pdfimgs_dir)
+        if os.path.exists(djvu_file):
+            tmp_bytes += os.path.getsize(djvu_file)
+            os.remove(djvu_file)
+        os.remove(pdf_file)
+
+    return tmp_bytes, passthrough
+
+
+def run_pages(pages, executor=None, **kwargs):
+    """Run shrink_page for each (index, pdf_file, plan) tuple in `pages`.
+
+    `kwargs` are passed on to shrink_page. Pages run on `executor` if
+    given, most expensive first so a large page started last doesn't
+    hold up the rest, otherwise one after another.
+    Results are returned in the same order as `pages`. If a page fails,
+    pages that haven't started yet are cancelled and its error is
+    raised.
+    """
+    if executor is None:
+        return [
+            shrink_page(pdf_file, i, plan, **kwargs)
+            for i, pdf_file, plan in pages
+        ]
+
+    futures = {}
+    for i, pdf_file, plan in sorted(pages, key=lambda p: -p[2]["cost"]):
+        futures[i] = executor.submit(shrink_page, pdf_file, i, plan, **kwargs)
+    done, not_done = wait(futures.values(), return_when=FIRST_EXCEPTION)
+    for future in done:
+        if future.exception():
+            for pending in not_done:
+                pending.cancel()
+            raise future.exception()
+    return [futures[i].result() for i, _, _ in pages]
+
+
+def shrink_pdf(args, tmpdir, executor=None, **kwargs):
+    """Write a shrunken copy of the input pdf to the output file.
+
+    The images of every page are inventoried first, which sets how each
+    page is extracted and the scale for the hocr files of every page.
+    Pages are then split and processed in `tmpdir` with shrink_page,
+    which is also passed `kwargs`, on `executor` if given.
+
+    Returns the peak number of bytes used in `tmpdir` and the number of
+    pages whose jpg was used as is. With an executor the pages of a
+    window are in flight at the same time, so in streaming mode the
+    peak is an upper bound.
+    """
+    peak_bytes = 0
+    num_passthrough = 0
+
+    last_page = args.max_pages if args.max_pages > 0 else None
+    plans = plan_pages(args.input_file, last_page)
+    scale_hocr = get_scale_hocr(plans[0], args.dpi)
+
+    text_layer = {}
+    if not (args.use_existing_hocr or args.djvu_hocr):
+        try:
+            text_layer = extract_text_layer(args.input_file, last_page)
+        except (OSError, subprocess.CalledProcessError, etree.Error) as e:
+            logging.warning(
+                "Can't read text layer, using djvu2hocr for all pages: %s", e
+            )
+    kwargs["text_pages"] = frozenset(text_layer)
+    aux_dir = kwargs.get("aux_dir")
+
+    if args.stream:
+        num_pages = len(plans)
+        width = len(str(num_pages))
+
+        # Bytes of finished jpg and hocr files which stay in tmpdir
+        # until the pdf is reassembled.
+        kept_bytes = 0
+
+        # Split off at most max_in_flight pages at a time and remove
+        # each page's intermediate files as soon as it is done.
+        for first in range(1, num_pages + 1, args.max_in_flight):
+            last = min(first + args.max_in_flight - 1, num_pages)
+            pdf_files = split_pages(
+                args.input_file, tmpdir, first, last, width
+            )
+            pages = [
+                (i, pdf_file, plans[i])
+                for i, pdf_file in enumerate(pdf_files, start=first - 1)
+            ]
+            split_bytes = sum(os.path.getsize(f) for f in pdf_files)
+
+            results = run_pages(
+                pages, executor, args=args, cleanup=True, **kwargs
+            )
+            write_text_hocr(pages, text_layer, scale_hocr, args, aux_dir)
+
+            tmp_bytes = sum(r[0] for r in results)
+            num_passthrough += sum(r[1] for r in results)
+            page_bytes = 0
+            for pdf_file in pdf_files:
+                basename = os.path.splitext(pdf_file)[0]
+                page_bytes += du(basename + ".jpg") + du(basename + ".hocr")
+            peak_bytes = max(
+                peak_bytes, kept_bytes + split_bytes + tmp_bytes + page_bytes
+            )
+            kept_bytes += page_bytes
+    else:
+        # split pdf into individual pdfs for each page
+        do_cmd([
+            "qpdf",
+            "--split-pages",
+            "--deterministic-id",
+            args.input_file,
+            "{}/%d.pdf".format(tmpdir),
+        ])
+
+        # Process each page until we have an hocr file
+        # and reduced jpg for each page
+        pdf_files = sorted(glob.glob(f"{tmpdir}/*.pdf"))
+        pages = [
+            (i, pdf_file, plan)
+            for i, (pdf_file, plan) in enumerate(zip(pdf_files, plans))
+        ]
+
+        results = run_pages(pages, executor, args=args, **kwargs)
+        num_passthrough = sum(r[1] for r in results)
+        write_text_hocr(pages, text_layer, scale_hocr, args, aux_dir)
+
+    # reassemble pdf by combining reduced images
+    # and extracted hocr files
+    tmp_pdf_file = f"{tmpdir}/tmp.pdf"
+    hocr_pdf = [
+        "hocr-pdf",
+        "--scale-hocr",
+        scale_hocr,
+        "--savefile",
+        tmp_pdf_file,
+    ]
+    if args.use_existing_hocr:
+        hocr_pdf.append("--reverse")
+    hocr_pdf.append(tmpdir)
+    do_cmd(hocr_pdf)
+    # strip metadata and linearize in a single write
+    pdf_assemble.assemble([tmp_pdf_file], args.output_file)
+
+    # Everything left in tmpdir is on disk at the same time
+    return max(peak_bytes, du(tmpdir)), num_passthrough
+
+
 def main():
     # Check for required tools
     tools = [
         "convert",
         "djvu2hocr",
-        "exiftool",
         "hocr-pdf",
         "pdf2djvu",
         "pdfimages",
+        "pdftotext",
         "qpdf",
     ]
 
@@ -123,6 +838,14 @@ def main():
         action="store_true",
         help="Use existing hOCR files from input directory",
     )
+    parser.add_argument(
+        "--djvu-hocr",
+        action="store_true",
+        help=(
+            "Extract hOCR with pdf2djvu and djvu2hocr even for pages "
+            "with a text layer"
+        ),
+    )
     parser.add_argument(
         "-m",
         "--max-pages",
@@ -137,6 +860,55 @@ def main():
         choices=[72, 96, 200],
         help="Resolution for PDF pages",
     )
+    parser.add_argument(
+        "--resample",
+        choices=jpeg_resample.METHODS,
+        default="quality",
+        help=(
+            "Resample with ImageMagick (quality) or, for jpegs reduced "
+            "2x or more, decode at a reduced size (speed) "
+            "(default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "-s",
+        "--stream",
+        action="store_true",
+        help=(
+            "Split and process pages a few at a time, removing "
+            "intermediate files as soon as each page is done"
+        ),
+    )
+    parser.add_argument(
+        "--max-in-flight",
+        type=int,
+        default=8,
+        metavar="N",
+        help=(
+            "Maximum number of split pages on disk at once in "
+            "streaming mode (default: %(default)s)"
+        ),
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        metavar="N",
+        help="Number of pages to process in parallel (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--hocr-cache",
+        metavar="DIR",
+        help="Directory to cache hOCR generated from each page",
+    )
+    parser.add_argument(
+        "--hocr-cache-size",
+        type=int,
+        default=2048,
+        metavar="MB",
+        help="Maximum size of the hOCR cache (default: %(default)s)",
+    )
     args = parser.parse_args()
 
     if args.debug:
@@ -151,6 +923,20 @@ def main():
     if not args.force and os.path.exists(args.output_file):
         sys.exit("Output file already exists.")
 
+    if args.max_in_flight < 1:
+        sys.exit("Maximum number of pages in flight must be at least 1.")
+
+    if args.jobs < 1:
+        sys.exit("Number of jobs must be at least 1.")
+
+    hocr_cache = None
+    if args.hocr_cache and not args.use_existing_hocr:
+        versions = [get_tool_version(prog) for prog in HOCR_TOOLS]
+        logging.debug("hocr tool versions: %s", versions)
+        hocr_cache = HocrCache(
+            args.hocr_cache, args.hocr_cache_size * 2**20, versions
+        )
+
     input_dir, input_file = os.path.split(args.input_file)
     logging.debug("input dir: %s", input_dir)
 
@@ -158,14 +944,15 @@ def main():
 
     rstar_dir = "/content/prod/rstar"
 
-    aux_exists = False
+    aux_dir = None
     objid = os.path.splitext(input_file)[0]
     match = re.search(r"^([a-z]+)_aco\d{6}$", objid)
     if match:
         partner_id = match.group(1)
         aux_dir = f"{rstar_dir}/content/{partner_id}/aco/wip/se/{objid}/aux"
         logging.debug("aux_dir: %s", aux_dir)
-        aux_exists = os.path.isdir(aux_dir)
+        if not os.path.isdir(aux_dir):
+            aux_dir = None
 
     tmp_rootdir = f"{rstar_dir}/tmp/aco"
     if not os.path.isdir(tmp_rootdir):
@@ -176,159 +963,40 @@ def main():
     tmpdir = tempfile.mkdtemp(dir=tmp_rootdir)
     logging.debug("temp directory: %s", tmpdir)
 
-    # split pdf into individual pdfs for each page
-    do_cmd(
-        ["qpdf", "--split-pages", args.input_file, "{}/%d.pdf".format(tmpdir)]
-    )
-
-    # Loop over each page until we have an hocr file
-    # and reduced jpg for each page
-    for i, pdf_file in enumerate(sorted(glob.glob(f"{tmpdir}/*.pdf"))):
+    # Each page runs its own convert processes, so keep them
+    # single threaded to avoid oversubscribing the cpus.
+    if args.jobs > 1:
+        os.environ["MAGICK_THREAD_LIMIT"] = "1"
+        os.environ["OMP_THREAD_LIMIT"] = "1"
 
-        if args.max_pages > 0 and i == args.max_pages:
-            break
+    page_kwargs = {
+        "hocr_files": hocr_files,
+        "aux_dir": aux_dir,
+        "hocr_cache": hocr_cache,
+    }
 
-        imginfo = get_img_info(pdf_file)
-        if not imginfo:
-            sys.exit(f"Can't find any images in {pdf_file}")
-        logging.debug("imginfo: %s", imginfo)
-        if imginfo["ext"] is None or imginfo["mask"]:
-            img_ext = "png"
-            pdfimgs_arg = "-png"
+    try:
+        if args.jobs > 1:
+            with ProcessPoolExecutor(max_workers=args.jobs) as executor:
+                peak_bytes, num_passthrough = shrink_pdf(
+                    args, tmpdir, executor, **page_kwargs
+                )
         else:
-            img_ext = imginfo["ext"]
-            pdfimgs_arg = "-all"
-
-        if i == 0:
-            scale_hocr = args.dpi / imginfo["dpi"]
-            if imginfo["mask"]:
-                scale_hocr *= (4 / 3) * (1 / 2)
-            logging.debug("Setting scale for hocr to %s", scale_hocr)
-
-        # set up file paths
-        basename = os.path.splitext(pdf_file)[0]
-        pdfimgs_dir = os.path.join(tmpdir, "pdfimgs_%03d" % (i + 1))
-        pdfimgs_base = os.path.join(pdfimgs_dir, os.path.basename(basename))
-        djvu_file = basename + ".djvu"
-        hocr_file = basename + ".hocr"
-        new_jpg_file = basename + ".jpg"
-        old_img_file = pdfimgs_base + "-000." + img_ext
-
-        logging.debug("Creating directory %s", pdfimgs_dir)
-        os.mkdir(pdfimgs_dir)
-
-        # extract jpg image from pdf page
-        do_cmd(["pdfimages", pdfimgs_arg, pdf_file, pdfimgs_base])
-
-        if imginfo["mask"]:
-            bot_layer = old_img_file
-            masked = pdfimgs_base + "-001." + img_ext
-            old_mask = pdfimgs_base + "-002." + img_ext
-            new_mask = pdfimgs_base + "-mask." + img_ext
-            top_layer = pdfimgs_base + "-top." + img_ext
-            merged = pdfimgs_base + "-merged." + img_ext
-            # mask image is twice as large as other images so we
-            # must resize it to match them before applying it
-            do_cmd(["convert", old_mask, "-resize", "50%", new_mask])
-            # apply mask to second image to form top/text layer
-            do_cmd([
-                "convert",
-                masked,
-                new_mask,
-                "-alpha",
-                "Off",
-                "-compose",
-                "CopyOpacity",
-                "-composite",
-                top_layer,
-            ])
-            # merge top/text layer with bottom layer to create
-            # final combined image
-            do_cmd(["convert", bot_layer, top_layer, "-composite", merged])
-            # move merged image so that it can shrunk by
-            # imagemagick in step below
-            mv(old_img_file, old_img_file + ".bak")
-            mv(merged, old_img_file)
-
-        # shrink image size by reducing quality
-        do_cmd([
-            "convert",
-            "-density",
-            imginfo["dpi"],
-            "-units",
-            "PixelsPerInch",
-            old_img_file,
-            "-resample",
-            args.dpi,
-            "-density",
-            args.dpi,
-            "-units",
-            "PixelsPerInch",
-            new_jpg_file,
-        ])
-
-        # Check that shrunken image has correct resolution
-        with PIL.Image.open(new_jpg_file) as new_jpg:
-            new_jpg_dpi = new_jpg.info["dpi"][0]
-        logging.debug("dpi %s: %s", new_jpg_file, new_jpg_dpi)
-        if new_jpg_dpi != args.dpi:
-            logging.error(
-                "Expected dpi %s for %s, found %s instead",
-                args.dpi,
-                new_jpg_file,
-                new_jpg_dpi,
+            peak_bytes, num_passthrough = shrink_pdf(
+                args, tmpdir, **page_kwargs
             )
-            sys.exit(1)
-
-        # # delete images extracted from pdfimages
-        # logging.debug("Removing directory %s", pdfimgs_dir)
-        # shutil.rmtree(pdfimgs_dir)
-
-        if args.use_existing_hocr:
-            # hocr files seem to shifted by 1
-            if i == len(hocr_files) - 1:
-                j = 0
-            else:
-                j = i + 1
-            logging.debug("Copying %s to %s", hocr_files[j], hocr_file)
-            shutil.copyfile(hocr_files[j], hocr_file)
-        else:
-            # convert pdf page to djvu file
-            do_cmd(["pdf2djvu", "-q", "-o", djvu_file, pdf_file])
-
-            # extract hidden text from djvu file as hocr
-            with open(hocr_file, "w") as f:
-                ret = do_cmd(
-                    ["djvu2hocr", djvu_file], stdout=f, stderr=subprocess.PIPE
-                )
-                logging.debug(ret.stderr.decode().strip())
-
-        # generating hocr is time consuming so we copy file
-        # to aux directory for later use
-        if aux_exists:
-            dest_file = aux_dir + "/" + os.path.basename(hocr_file)
-            if not os.path.isfile(dest_file):
-                shutil.copyfile(hocr_file, dest_file)
+    except Exception as e:
+        logging.error("Can't shrink %s: %s", args.input_file, e)
+        sys.exit(1)
+    finally:
+        logging.debug("Removing directory %s", tmpdir)
+        shutil.rmtree(tmpdir, ignore_errors=True)
 
-    # reassemble pdf by combining reduced images
-    # and extracted hocr files
-    tmp_pdf_file = f"{tmpdir}/tmp.pdf"
-    hocr_pdf = [
-        "hocr-pdf",
-        "--scale-hocr",
-        scale_hocr,
-        "--savefile",
-        tmp_pdf_file,
-    ]
-    if args.use_existing_hocr:
-        hocr_pdf.append("--reverse")
-    hocr_pdf.append(tmpdir)
-    do_cmd(hocr_pdf)
-    do_cmd(["exiftool", "-q", "-m", "-all:all=", tmp_pdf_file])
-    do_cmd(["qpdf", "--linearize", tmp_pdf_file, args.output_file])
+    print(f"Peak temporary disk usage: {format_size(peak_bytes)}")
+    print(f"Pages using the source jpeg as is: {num_passthrough}")
 
-    logging.debug("Removing directory %s", tmpdir)
-    shutil.rmtree(tmpdir)
+    if hocr_cache:
+        hocr_cache.evict()
 
 
 if __name__ == "__main__":
@@ -1,10 +1,23 @@
 #!/usr/bin/python3
 
 import argparse
+import io
+import mmap
+import random
+import sqlite3
+import struct
 import subprocess
 import sys
 import json
 import os
+import time
+from collections import Counter
+from concurrent.futures import (
+    FIRST_COMPLETED,
+    ThreadPoolExecutor,
+    as_completed,
+    wait,
+)
 
 
 # =========================================================
@@ -18,6 +31,239 @@ def run(cmd):
     )
 
 
+# =========================================================
+# tiff structure
+# =========================================================
+TAG_IMAGE_WIDTH = 256
+TAG_IMAGE_LENGTH = 257
+TAG_COMPRESSION = 259
+TAG_TILE_WIDTH = 322
+TAG_TILE_LENGTH = 323
+TAG_TILE_OFFSETS = 324
+TAG_TILE_BYTE_COUNTS = 325
+TAG_SUBIFDS = 330
+TAG_JPEG_TABLES = 347
+
+COMPRESSION_JPEG = 7
+
+# struct format for each tiff field type
+FIELD_TYPES = {
+    1: "B",  # BYTE
+    2: "c",  # ASCII
+    3: "H",  # SHORT
+    4: "I",  # LONG
+    6: "b",  # SBYTE
+    7: "B",  # UNDEFINED
+    8: "h",  # SSHORT
+    9: "i",  # SLONG
+    11: "f",  # FLOAT
+    12: "d",  # DOUBLE
+    13: "I",  # IFD
+    16: "Q",  # LONG8
+    17: "q",  # SLONG8
+    18: "Q",  # IFD8
+}
+
+# maximum number of directories to read, in case of a loop
+MAX_IFDS = 1000
+
+
+class TiffReader:
+    """
+    Read image file directories (IFDs) from a classic TIFF or BigTIFF.
+
+    The file is memory mapped, so only the pages holding the header
+    and the directories are actually read from disk.
+    """
+
+    def __init__(self, path):
+        with open(path, "rb") as f:
+            self.mm = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+
+        byte_order = self.mm[:2]
+        if byte_order == b"II":
+            self.bo = "<"
+        elif byte_order == b"MM":
+            self.bo = ">"
+        else:
+            self.close()
+            raise ValueError("Not a TIFF file")
+
+        version = self.unpack("H", 2)
+        if version == 42:
+            self.bigtiff = False
+            self.first_ifd = self.unpack("I", 4)
+        elif version == 43:
+            self.bigtiff = True
+            self.first_ifd = self.unpack("Q", 8)
+        else:
+            self.close()
+            raise ValueError(f"Unknown TIFF version {version}")
+
+    def close(self):
+        self.mm.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+    def unpack(self, fmt, offset, count=1):
+        values = struct.unpack_from(f"{self.bo}{count}{fmt}", self.mm, offset)
+        return values[0] if count == 1 else values
+
+    def read_ifd(self, offset):
+        """Return the tags of the IFD at `offset` and the next offset."""
+        if self.bigtiff:
+            count_fmt, entry_size, value_fmt, value_size = "Q", 20, "Q", 8
+        else:
+            count_fmt, entry_size, value_fmt, value_size = "H", 12, "I", 4
+        count_size = struct.calcsize(count_fmt)
+
+        num_entries = self.unpack(count_fmt, offset)
+        tags = {}
+        for i in range(num_entries):
+            entry = offset + count_size + i * entry_size
+            tag, field_type = self.unpack("H", entry, 2)
+            num_values = self.unpack(value_fmt, entry + 4)
+            fmt = FIELD_TYPES.get(field_type)
+            if fmt is None or fmt == "c":
+                continue
+            value_offset = entry + 4 + value_size
+            if struct.calcsize(fmt) * num_values > value_size:
+                value_offset = self.unpack(value_fmt, value_offset)
+            tags[tag] = (fmt, num_values, value_offset)
+
+        next_ifd = self.unpack(
+            value_fmt, offset + count_size + num_entries * entry_size
+        )
+        return tags, next_ifd
+
+    def tag_value(self, tags, tag, default=None):
+        """Return a tag's value, a tuple if it has more than one."""
+        if tag not in tags:
+            return default
+        fmt, num_values, value_offset = tags[tag]
+        return self.unpack(fmt, value_offset, num_values)
+
+    def tag_count(self, tags, tag):
+        return tags[tag][1] if tag in tags else 0
+
+    def tag_item(self, tags, tag, index):
+        """Return one value of an array tag without reading the rest."""
+        fmt, _, value_offset = tags[tag]
+        return self.unpack(fmt, value_offset + index * struct.calcsize(fmt))
+
+    def tag_bytes(self, tags, tag):
+        """Return the raw bytes of a BYTE or UNDEFINED tag."""
+        if tag not in tags:
+            return None
+        _, num_values, value_offset = tags[tag]
+        return self.mm[value_offset : value_offset + num_values]
+
+    def directories(self):
+        """
+        Yield the tags of every image in the file.
+
+        Each IFD in the main chain is followed by its SubIFDs, so both
+        page based and SubIFD based pyramids are returned in order.
+        """
+        seen = set()
+        offset = self.first_ifd
+        while offset and offset not in seen and len(seen) < MAX_IFDS:
+            seen.add(offset)
+            tags, offset = self.read_ifd(offset)
+            yield tags
+            subifds = self.tag_value(tags, TAG_SUBIFDS, ())
+            if not isinstance(subifds, tuple):
+                subifds = (subifds,)
+            for sub_offset in subifds:
+                if sub_offset in seen:
+                    continue
+                seen.add(sub_offset)
+                yield self.read_ifd(sub_offset)[0]
+
+
+def read_tiff_levels(path):
+    """Return a dict with the size, tiling and compression of each level."""
+    levels = []
+    with TiffReader(path) as tiff:
+        for tags in tiff.directories():
+            levels.append({
+                "width": tiff.tag_value(tags, TAG_IMAGE_WIDTH),
+                "height": tiff.tag_value(tags, TAG_IMAGE_LENGTH),
+                "tile_width": tiff.tag_value(tags, TAG_TILE_WIDTH),
+                "tile_height": tiff.tag_value(tags, TAG_TILE_LENGTH),
+                "compression": tiff.tag_value(tags, TAG_COMPRESSION, 1),
+            })
+    return levels
+
+
+def decode_jpeg_tile(data, jpeg_tables=None):
+    """Decode a JPEG compressed tile, raising an error if it is bad."""
+    import PIL.Image
+
+    # Tiles usually hold abbreviated JPEG streams with the shared
+    # quantization and huffman tables stored in the JPEGTables tag.
+    # Splice the tables (minus their EOI marker) in front of the
+    # tile data (minus its SOI marker).
+    if jpeg_tables:
+        data = jpeg_tables[:-2] + data[2:]
+    try:
+        img = PIL.Image.open(io.BytesIO(data))
+    except PIL.UnidentifiedImageError:
+        raise ValueError("unreadable JPEG data")
+    with img:
+        img.load()
+        return img.size
+
+
+def sample_tiles(path, num_tiles):
+    """
+    Read and decode up to `num_tiles` random tiles from each level.
+
+    Only one tile is held in memory at a time.
+
+    Returns a dict with the number of tiles decoded, the seconds spent
+    reading and decoding them and a list of errors found.
+    """
+    sampled = 0
+    errors = []
+    start = time.monotonic()
+    with TiffReader(path) as tiff:
+        for level, tags in enumerate(tiff.directories()):
+            num_level_tiles = tiff.tag_count(tags, TAG_TILE_OFFSETS)
+            compression = tiff.tag_value(tags, TAG_COMPRESSION, 1)
+            if not num_level_tiles or compression != COMPRESSION_JPEG:
+                continue
+            if tiff.tag_count(tags, TAG_TILE_BYTE_COUNTS) != num_level_tiles:
+                errors.append(f"level {level}: tile byte counts missing")
+                continue
+            jpeg_tables = tiff.tag_bytes(tags, TAG_JPEG_TABLES)
+            indexes = random.sample(
+                range(num_level_tiles), min(num_tiles, num_level_tiles)
+            )
+            for index in sorted(indexes):
+                offset = tiff.tag_item(tags, TAG_TILE_OFFSETS, index)
+                size = tiff.tag_item(tags, TAG_TILE_BYTE_COUNTS, index)
+                sampled += 1
+                if size == 0 or offset + size > len(tiff.mm):
+                    errors.append(f"level {level} tile {index}: truncated")
+                    continue
+                try:
+                    decode_jpeg_tile(
+                        tiff.mm[offset : offset + size], jpeg_tables
+                    )
+                except Exception as e:
+                    errors.append(f"level {level} tile {index}: {e}")
+    return {
+        "tiles_sampled": sampled,
+        "decode_seconds": round(time.monotonic() - start, 4),
+        "tile_errors": errors,
+    }
+
+
 # =========================================================
 # parsing
 # =========================================================
@@ -37,9 +283,20 @@ def parse_levels(tiffinfo_text):
     return levels
 
 
-def analyze_file(path):
+def analyze_file(path, use_tiffinfo=False, num_tiles=0):
     try:
-        info = run(["tiffinfo", path])
+        if use_tiffinfo:
+            info = run(["tiffinfo", path])
+            levels = parse_levels(info)
+            tiled = "Tile Width" in info
+            jpeg = "Compression Scheme: JPEG" in info
+        else:
+            tiff_levels = read_tiff_levels(path)
+            levels = [(lv["width"], lv["height"]) for lv in tiff_levels]
+            tiled = any(lv["tile_width"] for lv in tiff_levels)
+            jpeg = any(
+                lv["compression"] == COMPRESSION_JPEG for lv in tiff_levels
+            )
     except Exception as e:
         return {
             "file": path,
@@ -47,13 +304,11 @@ def analyze_file(path):
             "error": str(e),
         }
 
-    levels = parse_levels(info)
-
     result = {
         "file": path,
         # core properties
-        "tiled": "Tile Width" in info,
-        "jpeg": "Compression Scheme: JPEG" in info,
+        "tiled": tiled,
+        "jpeg": jpeg,
         # pyramid
         "levels": levels,
         "level_count": len(levels),
@@ -88,17 +343,178 @@ def analyze_file(path):
 
     result["pyramid"] = monotonic and len(levels) > 1
 
+    # decode sample of tiles
+    if num_tiles > 0:
+        try:
+            result.update(sample_tiles(path, num_tiles))
+        except Exception as e:
+            result["tile_errors"] = [str(e)]
+
     # final decision
     result["ok"] = (
         result["tiled"]
         and result["jpeg"]
         and result["pyramid"]
         and result["monotonic"]
+        and not result.get("tile_errors")
     )
 
     return result
 
 
+def failure_reason(result):
+    """Return a short reason why a file failed validation, or None."""
+    if result.get("ok"):
+        return None
+    if "levels" not in result:
+        return "Unreadable TIFF"
+    if result["error"]:
+        return result["error"]
+    if not result["tiled"]:
+        return "Not tiled"
+    if not result["jpeg"]:
+        return "Not JPEG compressed"
+    if result.get("tile_errors"):
+        return "Tiles fail to decode"
+    return "Levels not decreasing in size"
+
+
+def analyze_files(files, jobs=1, manifest=None, **kwargs):
+    """
+    Analyze files, running up to `jobs` of them at a time.
+
+    `kwargs` are passed on to analyze_file. Results are yielded as soon
+    as they are ready, so with more than one job they may be out of
+    order. Only a few files per job are queued at once, so memory use
+    doesn't grow with the number of files.
+
+    If a `manifest` is given, files it has a current result for are not
+    analyzed again and new results are saved to it.
+    """
+
+    def lookup(f):
+        if not manifest:
+            return None
+        return manifest.lookup(f, kwargs.get("num_tiles", 0) > 0)
+
+    def record(result):
+        if manifest:
+            manifest.store(result)
+        return result
+
+    if jobs == 1:
+        for f in files:
+            result = lookup(f)
+            yield result or record(analyze_file(f, **kwargs))
+        return
+
+    with ThreadPoolExecutor(max_workers=jobs) as executor:
+        pending = set()
+        try:
+            for f in files:
+                result = lookup(f)
+                if result:
+                    yield result
+                    continue
+                pending.add(executor.submit(analyze_file, f, **kwargs))
+                if len(pending) >= jobs * 4:
+                    done, pending = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        yield record(future.result())
+            for future in as_completed(pending):
+                pending.discard(future)
+                yield record(future.result())
+        finally:
+            # stop queued work if the caller stops early (--fail-fast)
+            for future in pending:
+                future.cancel()
+
+
+# =========================================================
+# manifest
+# =========================================================
+class Manifest:
+    """
+    SQLite database of earlier results.
+
+    A result is reused as long as the file's size, mtime and inode are
+    unchanged and it was checked less than `max_age` seconds ago.
+    """
+
+    def __init__(self, path, max_age=None):
+        self.conn = sqlite3.connect(path)
+        self.conn.execute("""
+            CREATE TABLE IF NOT EXISTS results (
+                path TEXT PRIMARY KEY,
+                size INTEGER,
+                mtime_ns INTEGER,
+                inode INTEGER,
+                checked REAL,
+                result TEXT
+            )
+            """)
+        self.max_age = max_age
+        # stat of files being analyzed, taken before they were read
+        self.stats = {}
+        self.num_stored = 0
+
+    def lookup(self, path, need_tiles=False):
+        """
+        Return the saved result for `path` if it is still current.
+
+        If `need_tiles` is set, results saved without a tile sample are
+        not current.
+        """
+        try:
+            st = os.stat(path)
+        except OSError:
+            return None
+        self.stats[path] = st
+
+        row = self.conn.execute(
+            "SELECT size, mtime_ns, inode, checked, result"
+            " FROM results WHERE path = ?",
+            (path,),
+        ).fetchone()
+        if not row:
+            return None
+        size, mtime_ns, inode, checked, result = row
+        if (size, mtime_ns, inode) != (st.st_size, st.st_mtime_ns, st.st_ino):
+            return None
+        if self.max_age is not None and time.time() - checked > self.max_age:
+            return None
+        result = json.loads(result)
+        if need_tiles and "tiles_sampled" not in result:
+            return None
+
+        del self.stats[path]
+        result["cached"] = True
+        return result
+
+    def store(self, result):
+        st = self.stats.pop(result["file"], None)
+        if not st:
+            return
+        self.conn.execute(
+            "INSERT OR REPLACE INTO results VALUES (?, ?, ?, ?, ?, ?)",
+            (
+                result["file"],
+                st.st_size,
+                st.st_mtime_ns,
+                st.st_ino,
+                time.time(),
+                json.dumps(result),
+            ),
+        )
+        self.num_stored += 1
+        if self.num_stored % 1000 == 0:
+            self.conn.commit()
+
+    def close(self):
+        self.conn.commit()
+        self.conn.close()
+
+
 # =========================================================
 # renderers
 # =========================================================
@@ -116,33 +532,51 @@ def render_cli(result):
     print(f"pyramid    = {result['pyramid']}")
     print(f"monotonic  = {result['monotonic']}")
     print(f"scale_ok   = {result['scale_ok']}")
+    if "tiles_sampled" in result:
+        print(f"tiles      = {result['tiles_sampled']}")
+        print(f"decode     = {result['decode_seconds']}s")
     print(f"OK         = {result['ok']}")
 
     print("\n=== LEVELS ===")
     for i, (w, h) in enumerate(result["levels"]):
         print(f"Level {i}: {w} x {h}")
 
+    if result.get("tile_errors"):
+        print("\n=== TILE ERRORS ===")
+        for error in result["tile_errors"]:
+            print(error)
+
 
 def render_json(results):
     print(json.dumps(results, indent=2))
 
 
+def render_ndjson(result):
+    print(json.dumps(result), flush=True)
+
+
+def render_summary(total, failures, num_cached=0):
+    print("\n=== TOTALS ===", file=sys.stderr)
+    print(f"files      = {total}", file=sys.stderr)
+    print(f"cached     = {num_cached}", file=sys.stderr)
+    print(f"ok         = {total - sum(failures.values())}", file=sys.stderr)
+    print(f"failed     = {sum(failures.values())}", file=sys.stderr)
+    for reason, count in failures.most_common():
+        print(f"  {count:8d}  {reason}", file=sys.stderr)
+
+
 # =========================================================
 # file expansion
 # =========================================================
 def collect_inputs(inputs):
-    files = []
-
     for item in inputs:
         if os.path.isdir(item):
             for root, _, names in os.walk(item):
                 for n in names:
                     if n.lower().endswith((".tif", ".tiff")):
-                        files.append(os.path.join(root, n))
+                        yield os.path.join(root, n)
         else:
-            files.append(item)
-
-    return files
+            yield item
 
 
 # =========================================================
@@ -154,31 +588,103 @@ def main():
     )
 
     parser.add_argument("inputs", nargs="+")
-    parser.add_argument("--json", action="store_true")
+    output = parser.add_mutually_exclusive_group()
+    output.add_argument("--json", action="store_true")
+    output.add_argument(
+        "--ndjson",
+        action="store_true",
+        help="print one JSON object per file as soon as it is checked",
+    )
     parser.add_argument("--fail-fast", action="store_true")
+    parser.add_argument(
+        "--tiffinfo",
+        action="store_true",
+        help="read tiff structure with tiffinfo instead of natively",
+    )
+    parser.add_argument(
+        "-j",
+        "--jobs",
+        type=int,
+        default=1,
+        help="number of files to check at once (default: %(default)s)",
+    )
+    parser.add_argument(
+        "--sample-tiles",
+        type=int,
+        default=0,
+        metavar="K",
+        help="decode K random tiles from each level of every file",
+    )
+    parser.add_argument(
+        "--manifest",
+        metavar="DB",
+        help="SQLite file of earlier results; only changed files are checked",
+    )
+    parser.add_argument(
+        "--revalidate-older-than",
+        type=float,
+        metavar="DAYS",
+        help="check files again if their saved result is older than DAYS",
+    )
 
     args = parser.parse_args()
 
+    if args.jobs < 1:
+        parser.error("--jobs must be at least 1")
+
+    if args.sample_tiles < 0:
+        parser.error("--sample-tiles must not be negative")
+
+    if args.revalidate_older_than is not None and not args.manifest:
+        parser.error("--revalidate-older-than requires --manifest")
+
+    manifest = None
+    if args.manifest:
+        max_age = None
+        if args.revalidate_older_than is not None:
+            max_age = args.revalidate_older_than * 24 * 60 * 60
+        manifest = Manifest(args.manifest, max_age)
+
     files = collect_inputs(args.inputs)
     results = []
+    total = 0
+    num_cached = 0
+    failures = Counter()
 
     exit_code = 0
 
-    for f in files:
-        r = analyze_file(f)
-        results.append(r)
+    for r in analyze_files(
+        files,
+        args.jobs,
+        manifest,
+        use_tiffinfo=args.tiffinfo,
+        num_tiles=args.sample_tiles,
+    ):
+        total += 1
+        if r.get("cached"):
+            num_cached += 1
+
+        # render
+        if args.json:
+            results.append(r)
+        elif args.ndjson:
+            render_ndjson(r)
+        else:
+            render_cli(r)
 
         if not r.get("ok", False):
+            failures[failure_reason(r)] += 1
             exit_code = 1
             if args.fail_fast:
                 break
 
-    # render
+    if manifest:
+        manifest.close()
+
     if args.json:
         render_json(results)
-    else:
-        for r in results:
-            render_cli(r)
+
+    render_summary(total, failures, num_cached)
 
     sys.exit(exit_code)
 